@@ -29,17 +29,23 @@
 
 
 import sys
-from math import cos, radians
+from cPickle import PicklingError
+from cStringIO import StringIO
+from math import cos, floor, radians, sqrt
+from os import name as osname
 import Blender
 from Blender import Armature, Mesh, Lamp, Image, Draw, Window
-from Blender.Mathutils import Matrix, RotationMatrix, TranslationMatrix, MatMultVec, Vector, Quaternion, Euler, TriangleNormal
+from Blender.Mathutils import Matrix, RotationMatrix, TranslationMatrix, MatMultVec, Vector, Quaternion, Euler
 from XPlaneUtils import *
 from XPlaneExport import *
 from XPlaneExport8_ManipOptionsInterpreter import decode
 #import time
+try:
+    import multiprocessing	# new in Python 2.6
+except ImportError:
+    multiprocessing=None
 
-datarefs={}
-(datarefs,foo)=getDatarefs()
+datarefs=LazyDatarefs()	# loaded on first use
 
 # Default X-Plane (not Blender) material (ambient & specular do jack)
 DEFMAT=((1,1,1), (0,0,0), 0)	# diffuse, emission, shiny
@@ -57,20 +63,98 @@ DEFMAT=((1,1,1), (0,0,0), 0)	# diffuse, emission, shiny
 # CLIGHT: a custom light with a dataref and all params
 # SMOKE: a smoke puff generator
 #
-class VT:
+# There can be millions of VTs so they just hold their coordinates as floats, in slots rather than an instance dict.
+# The v, n and uv properties return them as Vertex and UV objects, but code that handles lots of VTs should use the
+# coordinates directly.
+#
+class VT(object):
+    __slots__=['x','y','z',	# Vertex location
+               'nx','ny','nz',	# Vertex normal
+               's','t']		# Vertex UV tex coords
+
     def __init__(self, v, n, uv):
-        self.v=v	# Vertex location
-        self.n=n	# Vertex normal
-        self.uv=uv	# Vertex UV tex coords
+        self.x=v.x
+        self.y=v.y
+        self.z=v.z
+        self.nx=n.x
+        self.ny=n.y
+        self.nz=n.z
+        self.s=uv.s
+        self.t=uv.t
+
+    v=property(lambda self: Vertex(self.x, self.y, self.z))
+    n=property(lambda self: Vertex(self.nx, self.ny, self.nz))
+    uv=property(lambda self: UV(self.s, self.t))
 
     def __str__ (self):
-        return "%s\t%6.3f %6.3f %6.3f\t%s" % (self.v, self.n.x, self.n.y,
-                                              self.n.z, self.uv)
+        return VT_FMT[3:-1] % (self.x, self.y, self.z, self.nx, self.ny, self.nz,
+                               round(self.s,UV.ROUND), round(self.t,UV.ROUND))
 
     def equals (self, b, fudge=Vertex.LIMIT):
-        return (self.v.equals(b.v, fudge) and
-                self.n.equals(b.n, fudge) and
-                self.uv.equals(b.uv))
+        return (abs(self.x-b.x)<=fudge and abs(self.y-b.y)<=fudge and abs(self.z-b.z)<=fudge and
+                abs(self.nx-b.nx)<=fudge and abs(self.ny-b.ny)<=fudge and abs(self.nz-b.nz)<=fudge and
+                abs(self.s-b.s)<=UV.LIMIT and abs(self.t-b.t)<=UV.LIMIT)
+
+#
+# VTIndex: spatial hash of the VTs made from each Blender mesh vertex, used to weld face-corners.
+#
+# Blender shares vertices between faces but each face can have its own normal and UV, so one mesh vertex
+# can turn into several VTs.  Rather than scanning every VT made so far for a mesh vertex, the VTs are
+# bucketed by mesh vertex and by their normal and UV quantised into cells as wide as the merge window.
+# Position doesn't need quantising - every VT made from the same mesh vertex has the same position.
+# A value that lies within the merge window of a cell boundary is also looked up in the neighbouring cell,
+# so we never miss a VT that VT.equals would accept.  Of the VTs that match we pick the lowest index, which
+# is what the linear scan found first, so the output is unchanged.
+#
+class VTIndex:
+    def __init__(self, vt_list):
+        self.vt=vt_list		# master vertex table that the indices refer to
+        self.cells={}		# (mesh vertex index, quantised normal, quantised uv) -> [indices into vt_list]
+        self.ntol=Vertex.LIMIT*2	# generous merge windows to allow for floating point fuzz
+        self.uvtol=UV.LIMIT*2
+        self.nsize=self.ntol*2
+        self.uvsize=self.uvtol*2
+
+    def key(self, vi, vt):
+        return (vi,
+                int(floor(vt.nx/self.nsize)), int(floor(vt.ny/self.nsize)), int(floor(vt.nz/self.nsize)),
+                int(floor(vt.s/self.uvsize)), int(floor(vt.t/self.uvsize)))
+
+    # Return index of the lowest-numbered existing VT that vt can be welded to, or None
+    def find(self, vi, vt):
+        keys=[(vi,)]
+        for (x, tol, size) in [(vt.nx, self.ntol, self.nsize),
+                               (vt.ny, self.ntol, self.nsize),
+                               (vt.nz, self.ntol, self.nsize),
+                               (vt.s, self.uvtol, self.uvsize),
+                               (vt.t, self.uvtol, self.uvsize)]:
+            lo=int(floor((x-tol)/size))
+            hi=int(floor((x+tol)/size))
+            if lo==hi:
+                keys=[k+(lo,) for k in keys]
+            else:
+                keys=[k+(c,) for c in range(lo,hi+1) for k in keys]
+        best=None
+        for k in keys:
+            for j in self.cells.get(k, []):
+                if (best==None or j<best) and vt.equals(self.vt[j]):
+                    best=j
+        return best
+
+    def add(self, vi, j):
+        k=self.key(vi, self.vt[j])
+        if k in self.cells:
+            self.cells[k].append(j)
+        else:
+            self.cells[k]=[j]
+
+    # Weld vt into existing VT j by averaging their UVs. Moves j to its new cell.
+    def weld(self, vi, j, vt):
+        q=self.vt[j]
+        self.cells[self.key(vi, q)].remove(j)
+        q.s=(q.s+vt.s)/2
+        q.t=(q.t+vt.t)/2
+        self.add(vi, j)
 
 class VLINE:
     def __init__(self, v, c):
@@ -161,6 +245,44 @@ class SMOKE:
     def equals (self, b):
         return (isinstance(b,SMOKE) and self.v.equals(b.v) and self.n==b.n and self.p==b.p)
 
+#----------------------------------------------------------------------------------------------------------------
+# TABLE OUTPUT
+#----------------------------------------------------------------------------------------------------------------
+# The vertex and index tables are written a chunk at a time, with one format string per row (or per chunk of
+# rows for the indices) instead of one write and several __str__ calls per row.  The formats must match
+# VT.__str__, VLINE.__str__, VLIGHT.__str__, Vertex.__str__ and UV.__str__ exactly.
+#
+TABLE_CHUNK=1024	# rows per write
+VT_FMT="VT\t%9.4f %9.4f %9.4f\t%6.3f %6.3f %6.3f\t%-6s %-6s\n"
+VLINE_FMT="VLINE\t%9.4f %9.4f %9.4f\t%6.3f %6.3f %6.3f\n"
+VLIGHT_FMT="VLIGHT\t%9.4f %9.4f %9.4f\t%6.3f %6.3f %6.3f\n"
+IDX10_FMT="IDX10\t%s %s %s %s %s %s %s %s %s %s\n"
+
+def write_tables(file, vt, vline, vlight, indices):
+    for i in range(0, len(vt), TABLE_CHUNK):
+        file.write(''.join([VT_FMT % (q.x, q.y, q.z, q.nx, q.ny, q.nz,
+                                      round(q.s,UV.ROUND), round(q.t,UV.ROUND))
+                            for q in vt[i:i+TABLE_CHUNK]]))
+    if vt:
+        file.write("\n")
+
+    for (table, fmt) in [(vline, VLINE_FMT), (vlight, VLIGHT_FMT)]:
+        for i in range(0, len(table), TABLE_CHUNK):
+            file.write(''.join([fmt % (q.v.x, q.v.y, q.v.z,
+                                       round(q.c[0],2), round(q.c[1],2), round(q.c[2],2))
+                                for q in table[i:i+TABLE_CHUNK]]))
+        if table:
+            file.write("\n")
+
+    n=len(indices)
+    full=n-(n%10)	# number of indices that go in IDX10s
+    for i in range(0, full, 10*TABLE_CHUNK):
+        j=min(i+10*TABLE_CHUNK, full)
+        file.write((IDX10_FMT*((j-i)/10)) % tuple(map(str, indices[i:j])))	# str() is quicker than %d
+    for i in range(full, n):
+        file.write("IDX\t%d\n" % indices[i])
+
+
 #----------------------------------------------------------------------------------------------------------------
 # STATE SORTED PRIMITIVE
 #----------------------------------------------------------------------------------------------------------------
@@ -216,7 +338,12 @@ class SMOKE:
 # change of current attributes) is a pretty accurate representation of what really happens.  (E.g. if you have poly_os
 # on and you draw  light, x-plane _does_ turn poly_os off temporarily, then turn it back on again!)
 #
-class Prim:
+# There is one prim per face, so prims keep their attributes in slots rather than an instance dict.
+#
+class Prim(object):
+    __slots__=['i', 'offset', 'count', 'style', 'anim', 'anim_idx', 'flags', 'alpha', 'region', 'surface',
+               'mat', 'group', 'layer', 'layer_now', 'image', 'lit_level', 'debug_name', 'manip']
+
     # Flags in sort order - lower indices are tweaked more often
     # This group breaks up a batch but does not touch the GPU - they are therefore not _that_ expensive to process and
     # we would prefer to vary them at high frequency...
@@ -239,6 +366,7 @@ class Prim:
     TEST=1      # Test but don't blend - cutoff controlled by "blend cut" in tuple.   Good for trees!
     SHADOWTEST=2# Test for shadows, blend for drawing, cutoff used for shadows, back-to-front sorting to avoid Z halo in non-shadow render.
     BLEND=3     # True blending, no cutoff used.  This means we need back-to-front sorting to avoid Z halo.
+    NOALPHA=[OPAQUE,0.0]
 
     SURFACES=[None, 'water', 'concrete', 'asphalt', 'grass', 'dirt', 'gravel', 'lakebed', 'snow', 'shoulder', 'blastpad']
     STYLE=['Tri','Line','VLight','NLight']
@@ -256,14 +384,13 @@ class Prim:
 
     def __init__ (self, object, group, flags, surface, mat, img, anim, aidx,style):
         self.i=[]		# indices for lines & tris, VLIGHT/NLIGHT for lights within master geometry table
-        self.geo=[]		# cache of 3 vectors, our normal, our plane eq 'D', and our centroid for this tri.
         self.offset=-1	# range of our indices within the master index table for tris and lines
         self.count=-1
         self.style=style
         self.anim=anim
         self.anim_idx=aidx
         self.flags=flags	# bitmask
-        self.alpha=[Prim.OPAQUE,0.0]
+        self.alpha=Prim.NOALPHA	# shared - replaced, never modified in place
         self.region=-1	# image, -1 for no region
         self.surface=surface	# tris: one of Prim.SURFACES
         self.mat=mat		# tris: (diffuse, emission, shiny)
@@ -272,27 +399,9 @@ class Prim:
         self.layer_now=-1		# This is the one layer we pay attention to now for sorting or state update.
         self.image=img
         self.lit_level=None
-        self.draw_disable=0
-        self.solid_camera=0
         self.debug_name = object.name
         self.manip=""
 
-    def cache(self, vt_list):
-        if self.style=='Tri':
-            v1 = vt_list[self.i[0]]
-            v2 = vt_list[self.i[1]]
-            v3 = vt_list[self.i[2]]
-            vv1 = Vector(v1.v.x,v1.v.y,v1.v.z)
-            vv2 = Vector(v2.v.x,v2.v.y,v2.v.z)
-            vv3 = Vector(v3.v.x,v3.v.y,v3.v.z)
-            n = TriangleNormal(vv1,vv2,vv3)
-            self.geo.append(vv1)
-            self.geo.append(vv2)
-            self.geo.append(vv3)
-            self.geo.append(n)
-            self.geo.append(-n.dot(vv1))
-            self.geo.append((vv1 + vv2 + vv3) / 3.0)
-
     #----------------------------------------------------------------------------------------------------------------
     # STATE PRIORITIZATION
     #----------------------------------------------------------------------------------------------------------------
@@ -303,111 +412,124 @@ class Prim:
     # can read this as saying: the exporter wil sort first by LOD, then by surface.  Thus the surface may be changed many
     # times as it must be reset inside each LOD.
     #
-    # So: to see other optimizations, simpyl change the order of this loop.  A few interesting notes:
+    # So: to see other optimizations, change the weights in STATE_WEIGHTS below (or set the state_weights property)
+    # and compare the state change counts in the export report.  A few interesting notes:
     # - Primitive type of line/light (self.style) is state, so we can force consoldiation by primitive type.  This might
     #   pay off in some cases - testing is needed!
     # - Animation (by index) is state, so we can choose to prioritize other change over animation.  The exporter will
     #   put the animation in twice to minimize other state change.
-
-    def __cmp__ (self,other):
-        if self.layer_now != other.layer_now:				# LOD - highest prio, must be on outside
-            return cmp(self.layer_now,other.layer_now)
-        elif self.group != other.group:				# respect groups, then
-            return cmp_grp(self.group,other.group)
-        elif self.lit_level != other.lit_level:
-            return cmp(self.lit_level,other.lit_level)
-        elif (self.alpha != other.alpha):
-            return cmp(self.alpha,other.alpha)
-        elif (self.flags&Prim.BUCKET2) != (other.flags&Prim.BUCKET2):
-            return cmp((self.flags&Prim.BUCKET2),(other.flags&Prim.BUCKET2))
-        elif self.anim_idx != other.anim_idx:				# don't dupe animation...well except for panels.
-            return cmp(self.anim_idx,other.anim_idx)
-        elif self.mat != other.mat:
-            return cmp_mat(self.mat,other.mat)
-        elif (self.flags&Prim.BUCKET1) != (other.flags&Prim.BUCKET1):
-            return cmp((self.flags&Prim.BUCKET1),(other.flags&Prim.BUCKET1))
-        elif self.region != other.region:				# cockpit tex and materials mean shader change, as do some of the flags
-            return cmp(self.region,other.region)
-        elif self.style != other.style:
-            return cmp(self.style,other.style)
-        elif self.image != other.image:
-            return cmp(self.image,other.image)
-        elif self.manip != other.manip:
-            return cmp(self.manip,other.manip)
-        elif self.surface != other.surface:
-            return cmp(self.surface,other.surface)
-        elif self.style == 'Tri':
-            if self.alpha[0] > Prim.    TEST:
-                #print self.i, other.i
-                r = order_tris(self.geo,other.geo)    # back to front order
-                #if r == -1:
-                #    print self.i, other.i
-                #elif r == 1:
-                #    print other.i, self.i
-                #else:
-                #    print "tie"
-                return r
-            else:
-                return order_tris(other.geo,self.geo)    # front to back - if opaque, this reduces fill rate!
+    #
+    # The state is returned as one tuple so that the exporter can sort with key= - calling a Python-level __cmp__
+    # O(n log n) times was the most expensive part of exporting a large object.  Fields that need special ordering are
+    # wrapped so that plain tuple comparison does the right thing: no group sorts first then groups by name, DEFMAT
+    # sorts before all other materials, and images are ordered by name.  Tris in the same state are then ordered
+    # geometrically by sort_prims.
+
+    def sortkey(self, order=None):
+        if self.group==None:
+            group=(0,)
         else:
-            return 0
-
-def cmp_mat(a, b):
-    if a == DEFMAT:
-        return -1
-    elif b == DEFMAT:
-        return 1
-    else:
-        return cmp(a,b)
-
-def cmp_grp(a, b):
-    if a == None:
-        return -1
-    elif b == None:
-        return 1
-    else:
-        return cmp(a.name, b.name)
-
-def order_tris__(a, b):
-    print a
-    print b
-
-    a0=cmp(b[3].dot(a[0])+b[4],0)
-    a1=cmp(b[3].dot(a[1])+b[4],0)
-    a2=cmp(b[3].dot(a[2])+b[4],0)
-    b0=cmp(a[3].dot(b[0])+a[4],0)
-    b1=cmp(a[3].dot(b[1])+a[4],0)
-    b2=cmp(a[3].dot(b[2])+a[4],0)
-    print a0, a1, a2, b0, b1, b2
-    a_pos = a0 > 0 or a1 > 0 or a2 > 0
-    a_neg = a0 < 0 or a1 < 0 or a2 < 0
-    b_pos = b0 > 0 or b1 > 0 or b2 > 0
-    b_neg = b0 < 0 or b1 < 0 or b2 < 0
-    a_split = a_pos and a_neg
-    b_split = b_pos and b_neg
-    aa = a0 + a1 + a2
-    bb = b0 + b1 + b2
-    print aa, bb, a_split, b_split
-    if a_split and b_split:
-        print "dual split!!"
-        return 0
-    if a_split: return 1
-    if b_split: return -1
-    if aa < 0 and bb < 0:
-        print "toplogical ambig"
-        return 0
-    if a_neg: return 1
-    if b_neg: return -1
-
-    return 0
+            group=(1,self.group.name)
+        if self.mat==DEFMAT:
+            mat=(0,)
+        else:
+            mat=(1,self.mat)
+        if self.image==None:
+            image=(0,)
+        else:
+            image=(1,self.image.name)
+        key=(self.layer_now,				# LOD - highest prio, must be on outside
+             group,					# respect groups, then
+             self.lit_level,
+             tuple(self.alpha),
+             self.flags&Prim.BUCKET2,
+             self.anim_idx,				# don't dupe animation...well except for panels.
+             mat,
+             self.flags&Prim.BUCKET1,
+             self.region)				# cockpit tex and materials mean shader change, as do some of the flags
+        if order:
+            key=tuple([key[i] for i in order])
+        return key+(self.style,
+                    image,
+                    self.manip,
+                    self.surface)
+
+# The weighted fields of Prim.sortkey, in default order, and their weights. The higher the weight the more expensive
+# that state is to change, so the less often the exporter changes it.  The LOD is always outermost whatever its weight
+# since each LOD must be written exactly once.  Beware that giving alpha or BUCKET2 a low weight can put blended or
+# poly_os geometry before the things that it must be drawn after.
+STATE_FIELDS=['lod', 'group', 'lit_level', 'alpha', 'bucket2', 'anim', 'material', 'bucket1', 'region']
+STATE_WEIGHTS={'lod':90, 'group':80, 'lit_level':70, 'alpha':60, 'bucket2':50, 'anim':40, 'material':30, 'bucket1':20, 'region':10}
+
+# Order of the weighted fields of Prim.sortkey for a dict of weights. Fields with equal weights keep their default order.
+def state_order(weights):
+    fields=STATE_FIELDS[1:]
+    for f in weights.keys():
+        if not f in STATE_FIELDS:
+            raise ExportError('Unknown state "%s" in state weights.|Use one of: %s' % (f, ', '.join(STATE_FIELDS)))
+    fields.sort(key=lambda f: -weights.get(f, STATE_WEIGHTS[f]))
+    return [0]+[STATE_FIELDS.index(f) for f in fields]
+
+# Parse a state_weights property of the form "anim=100 material=5"
+def parse_weights(s):
+    weights={}
+    for w in s.replace(',',' ').split():
+        try:
+            (f,v)=w.split('=')
+            weights[f.strip().lower()]=float(v)
+        except ValueError:
+            raise ExportError('Invalid state weight "%s".|Use name=weight, e.g. "anim=100 material=5"' % w)
+    return weights
+
+# Sort prims into state order, and then order tris within each run of identical state.
+# The tris' planes are only worked out for the runs that need ordering, and are dropped once the run is sorted.
+def sort_prims(prims, vt_list, order=None):
+    keyed=[(p.sortkey(order), p) for p in prims]
+    keyed.sort(key=lambda x: x[0])
+    prims[:]=[x[1] for x in keyed]
+
+    i=0
+    n=len(prims)
+    while i<n:
+        key=keyed[i][0]
+        j=i+1
+        while j<n and keyed[j][0]==key:
+            j+=1
+        if j-i>1 and prims[i].style=='Tri':
+            run=tri_planes(prims[i:j], vt_list)
+            if prims[i].alpha[0] > Prim.TEST:
+                run.sort(lambda a,b: order_tris(a[0],b[0]))    # back to front order
+            else:
+                run.sort(lambda a,b: order_tris(b[0],a[0]))    # front to back - if opaque, this reduces fill rate!
+            prims[i:j]=[x[1] for x in run]
+        i=j
+
+# Pair each tri with its corners and plane: (x1,y1,z1, x2,y2,z2, x3,y3,z3, nx,ny,nz, d) where nx,ny,nz is the unit
+# normal and d is the plane eq 'D'.  Plain floats rather than Vectors, since there's one per tri in a sorted run.
+def tri_planes(prims, vt_list):
+    planes=[]
+    for p in prims:
+        v1=vt_list[p.i[0]]
+        v2=vt_list[p.i[1]]
+        v3=vt_list[p.i[2]]
+        (ux,uy,uz)=(v2.x-v1.x, v2.y-v1.y, v2.z-v1.z)
+        (wx,wy,wz)=(v3.x-v1.x, v3.y-v1.y, v3.z-v1.z)
+        (nx,ny,nz)=(uy*wz-uz*wy, uz*wx-ux*wz, ux*wy-uy*wx)
+        l=sqrt(nx*nx+ny*ny+nz*nz)
+        if l:
+            (nx,ny,nz)=(nx/l, ny/l, nz/l)
+        planes.append(((v1.x,v1.y,v1.z, v2.x,v2.y,v2.z, v3.x,v3.y,v3.z, nx,ny,nz, -(nx*v1.x+ny*v1.y+nz*v1.z)), p))
+    return planes
 
 def order_tris(a, b):
-    a0=cmp(b[3].dot(a[0])+b[4],0)
-    a1=cmp(b[3].dot(a[1])+b[4],0)
-    a2=cmp(b[3].dot(a[2])+b[4],0)
-    b0=cmp(a[3].dot(b[0])+a[4],0)
-    b1=cmp(a[3].dot(b[1])+a[4],0)
-    b2=cmp(a[3].dot(b[2])+a[4],0)
+    (nx,ny,nz,d)=b[9:13]
+    a0=cmp(nx*a[0]+ny*a[1]+nz*a[2]+d,0)
+    a1=cmp(nx*a[3]+ny*a[4]+nz*a[5]+d,0)
+    a2=cmp(nx*a[6]+ny*a[7]+nz*a[8]+d,0)
+    (nx,ny,nz,d)=a[9:13]
+    b0=cmp(nx*b[0]+ny*b[1]+nz*b[2]+d,0)
+    b1=cmp(nx*b[3]+ny*b[4]+nz*b[5]+d,0)
+    b2=cmp(nx*b[6]+ny*b[7]+nz*b[8]+d,0)
     a=a0+a1+a2
     b=b0+b1+b2
     if a == -3:		return 1
@@ -422,6 +544,185 @@ def order_tris(a, b):
 
     else:			return 0
 
+#----------------------------------------------------------------------------------------------------------------
+# VERTEX CACHE OPTIMISATION
+#----------------------------------------------------------------------------------------------------------------
+# Tom Forsyth's "Linear-Speed Vertex Cache Optimisation". Faces are emitted greedily, always picking the
+# adjacent face with the highest score, where a vertex scores more the more recently it was used and the
+# fewer unemitted faces it has left.  Only runs of prims whose state is identical and whose order doesn't
+# matter are reordered - blended tris must stay in the back-to-front order that sort_prims gave them.
+
+FORSYTH_DECAY=1.5
+FORSYTH_LAST_TRI=0.75
+FORSYTH_VALENCE_SCALE=2.0
+FORSYTH_VALENCE_POWER=0.5
+
+# Average number of cache misses per triangle for a list of tri indices with a FIFO cache
+def acmr(indices, cachesize):
+    if not indices: return 0.0
+    cache=[]
+    incache={}
+    misses=0
+    for i in indices:
+        if not i in incache:
+            misses+=1
+            cache.append(i)
+            incache[i]=True
+            if len(cache)>cachesize:
+                del incache[cache.pop(0)]
+    return misses*3.0/len(indices)
+
+# Returns the order in which to draw faces, each a list of vertex indices
+def forsyth(faces, cachesize):
+    nfaces=len(faces)
+    adjacent={}		# vertex -> indices of unemitted faces that use it
+    for f in range(nfaces):
+        for v in faces[f]:
+            if v in adjacent:
+                if adjacent[v][-1]!=f: adjacent[v].append(f)
+            else:
+                adjacent[v]=[f]
+    cache=[]		# most recent first
+    position={}		# vertex -> position in cache
+
+    def vscore(v):
+        n=len(adjacent[v])
+        if not n: return -1.0
+        p=position.get(v, -1)
+        if p<0:
+            score=0.0
+        elif p<3:
+            score=FORSYTH_LAST_TRI
+        else:
+            score=(1.0-float(p-3)/(cachesize-3))**FORSYTH_DECAY
+        return score+FORSYTH_VALENCE_SCALE*n**-FORSYTH_VALENCE_POWER
+
+    vscores={}
+    for v in adjacent: vscores[v]=vscore(v)
+    fscores=[sum([vscores[v] for v in face]) for face in faces]
+    emitted=[False]*nfaces
+    order=[]
+    best=None
+    cursor=0		# for when no face in the cache is left
+    while len(order)<nfaces:
+        if best==None:
+            while emitted[cursor]: cursor+=1
+            best=cursor
+        order.append(best)
+        emitted[best]=True
+        for v in faces[best]:
+            if best in adjacent[v]: adjacent[v].remove(best)
+
+        # Move this face's vertices to the front of the cache
+        old=cache
+        cache=[]
+        for v in faces[best]:
+            if not v in cache: cache.append(v)
+        for v in old:
+            if not v in position or position[v]<0: continue
+            if not v in cache: cache.append(v)
+        evicted=cache[cachesize:]
+        cache=cache[:cachesize]
+        for v in evicted: position[v]=-1
+        for p in range(len(cache)): position[cache[p]]=p
+
+        # Rescore affected vertices and faces, and pick the best face
+        touched={}
+        for v in cache+evicted:
+            vscores[v]=vscore(v)
+            for f in adjacent[v]: touched[f]=True
+        best=None
+        bestscore=-1.0
+        for f in touched:
+            fscores[f]=sum([vscores[v] for v in faces[f]])
+            if fscores[f]>bestscore or (fscores[f]==bestscore and f<best):
+                best=f
+                bestscore=fscores[f]
+    return order
+
+# Reorder tri prims within each run of identical state for the vertex cache
+def reorder_prims(prims, cachesize):
+    i=0
+    n=len(prims)
+    while i<n:
+        p=prims[i]
+        if p.style!='Tri' or p.alpha[0]>Prim.TEST:	# back-to-front order matters for blended tris
+            i+=1
+            continue
+        key=(p.sortkey(), p.flags, p.layer)
+        j=i+1
+        while j<n and prims[j].style=='Tri' and (prims[j].sortkey(), prims[j].flags, prims[j].layer)==key:
+            j+=1
+        if j-i>1:
+            run=prims[i:j]
+            prims[i:j]=[run[k] for k in forsyth([q.i for q in run], cachesize)]
+        i=j
+
+#----------------------------------------------------------------------------------------------------------------
+# ANIMATED MESH REUSE
+#----------------------------------------------------------------------------------------------------------------
+# Children of animations are often duplicates - e.g. hundreds of identical switches in a cockpit.  Rather than
+# comparing a new animated mesh against every mesh exported so far, meshes are indexed by their stream of
+# face-corners: the number of corners in each face and the position of each corner, quantised to a grid.  Switches
+# and knobs are usually modelled around their pivot, so their centres and face counts are alike, but their corners
+# differ.
+#
+# A corner that lies within tolerance of a cell boundary could match a mesh in either cell, so it is looked up in
+# both.  Probing every combination for a whole mesh would take exponentially many lookups, so the streams are kept
+# in a trie and a lookup follows only the probes that some earlier mesh shares, which is usually just one.  The
+# meshes that are found are then compared exactly by OBJexport8.matchesAnim.
+#
+ANIM_LIMIT=Vertex.LIMIT*10	# tolerance used by matchesAnim
+ANIM_QUANTUM=ANIM_LIMIT*32	# so that few corners are within tolerance of a cell boundary
+
+class AnimIndex:
+    def __init__(self):
+        self.nodes={}		# (parent node, corners in face, quantised position) -> node
+        self.meshes={}		# node at the end of meshes' streams -> [indices into tris of candidates for reuse]
+
+    def add(self, corners, starttri):
+        size=ANIM_QUANTUM
+        node=0			# root
+        for vts in corners:
+            for vt in vts:
+                k=(node, len(vts), int(floor(vt.x/size)), int(floor(vt.y/size)), int(floor(vt.z/size)))
+                if k in self.nodes:
+                    node=self.nodes[k]
+                else:
+                    node=self.nodes[k]=len(self.nodes)+1
+        if node in self.meshes:
+            self.meshes[node].append(starttri)
+        else:
+            self.meshes[node]=[starttri]
+
+    # Candidates for reuse by a mesh with these corners
+    def find(self, corners):
+        (tol,size)=(ANIM_LIMIT,ANIM_QUANTUM)
+        near=tol/size		# fraction of a cell that is within tolerance of its boundary
+        index=self.nodes
+        nodes=[0]
+        for vts in corners:
+            n=len(vts)
+            for vt in vts:
+                (x,y,z)=(vt.x/size, vt.y/size, vt.z/size)
+                (cx,cy,cz)=(int(floor(x)), int(floor(y)), int(floor(z)))
+                if near<x-cx<1-near and near<y-cy<1-near and near<z-cz<1-near and len(nodes)==1:
+                    k=(nodes[0], n, cx, cy, cz)	# the usual case - nowhere near a cell boundary
+                    if not k in index:
+                        return []
+                    nodes=[index[k]]
+                else:
+                    cells=[range(int(floor((v-tol)/size)), int(floor((v+tol)/size))+1) for v in (vt.x,vt.y,vt.z)]
+                    nodes=[index[k] for node in nodes
+                           for cx in cells[0] for cy in cells[1] for cz in cells[2]
+                           for k in [(node, n, cx, cy, cz)] if k in index]
+                    if not nodes:
+                        return []
+        cands=[]
+        for node in nodes:
+            cands.extend(self.meshes.get(node, []))
+        return cands
+
 def safe_image_for_face(m,f):
     if not m.faceUV:
         return None
@@ -442,6 +743,8 @@ class OBJexport8:
         self.debug=0	# extra debug info in console
         self.local_export=0
         self.use_mat=1
+        self.vertex_cache=0	# size of vertex cache to optimise triangle order for, 0 for none
+        self.state_weights=STATE_WEIGHTS	# cost of changing each state, see Prim.sortkey
 
         #--- class private don't touch ---
         self.file=None
@@ -463,6 +766,10 @@ class OBJexport8:
         self.v10=False		# Used v10 features
         self.additive_lod=0
         self.instanced=0
+        self.detached=False	# see detach()
+        self.stats={}		# number of each command written to the command table, see StateCounter
+        self.shared={}		# attribute values shared between prims, see share()
+        self.preamble=''
         self.global_alpha=[Prim.BLEND,0.0]
         self.global_nshadow=False
         #
@@ -482,7 +789,7 @@ class OBJexport8:
         self.layer=0
         self.group=None
         self.lod=None		# list of lod limits
-        self.anim=Anim(self, None)
+        self.anim=None		# set to the null animation below
         self.manip=""
         self.image=None
         #
@@ -509,7 +816,9 @@ class OBJexport8:
         # Global list of all known animations, materials, groups.  We need groups because we have to search top-down to find objs.
         # We need animations to convert anim to index for sorting.  Ben say: I think we do NOT need a global material list anymore.
         #
-        self.anims=[Anim(self, None)]
+        self.anims=[Anim(self, None)]	# interned by makeAnim, the first is the null animation
+        self.anims[0].intern(None, 0)
+        self.anim=self.anims[0]
 #       self.mats=[DEFMAT]	# list of (diffuse, emission, shiny)
         if Blender.Get('version')>=242:	# new in 2.42
             self.groups=Blender.Group.Get()
@@ -521,13 +830,18 @@ class OBJexport8:
         # When we have a mesh on an armiture, it might be that the same mesh is used multiple times.  This lets us
         # look for duplicates and reuse them.
         #
-        self.animcands=[]	# indices into tris of candidates for reuse
+        self.animindex=AnimIndex()	# candidates for reuse
 
     #------------------------------------------------------------------------
-    def openFile(self, objects, outer_empty, prefix):
+    # If batch then output is held in memory until the exporter is written
+    # by writeBatch.
+    def openFile(self, objects, outer_empty, prefix, batch=False):
         print 'Starting OBJ export to ' + self.filename
         self.prefix=prefix
-        self.file = open(self.filename, 'w')
+        if batch:
+            self.file = StringIO()
+        else:
+            self.file = open(self.filename, 'w')
         self.texture=getTexture(self,objects,False,8)
         self.texture_draped=getTexture(self,objects,False,8,True)
         print "starting %d objects." % len(objects)
@@ -629,6 +943,19 @@ class OBJexport8:
     #------------------------------------------------------------------------
     #------------------------------------------------------------------------
     def writeObjects (self, theObjects):
+        self.collectObjects(theObjects)
+        self.writeCollected()
+
+    #------------------------------------------------------------------------
+    # Everything that needs Blender - global properties and scene exploration
+    def collectObjects (self, theObjects):
+        snapshot=snapshot_props(theObjects)
+        try:
+            self.exploreObjects(theObjects)
+        finally:
+            if snapshot: release_props()
+
+    def exploreObjects (self, theObjects):
 
         #------------------------------------------------------------------------
         # GLOBAL PROPERTY SUCK_UP
@@ -655,10 +982,13 @@ class OBJexport8:
         if a_obj != None:
             self.instanced=int(get_prop(a_obj,'instanced',self.additive_lod))
 
-        if self.layermask==1:
-            lseq=[1]
-        else:
-            lseq=[1,2,4]
+        a_obj=find_prop_list(theObjects, 'vertex_cache')
+        if a_obj != None:
+            self.vertex_cache=int(get_prop(a_obj,'vertex_cache',self.vertex_cache))
+
+        a_obj=find_prop_list(theObjects, 'state_weights')
+        if a_obj != None:
+            self.state_weights=parse_weights(str(get_prop(a_obj,'state_weights','')))
 
         # Speed optimisation
         if self.iscockpit:
@@ -710,6 +1040,42 @@ class OBJexport8:
             #    print 'Warn:\tIgnoring %s "%s"' % (objType.lower(),object.name)
             #    self.log.append(('Ignoring %s "%s"' % (objType.lower(), object.name),[object]))
 
+    #------------------------------------------------------------------------
+    # Replace references to Blender data with plain Python stand-ins so that
+    # the exporter can be pickled and writeCollected run in another process.
+    # Whatever has been written so far is kept as the preamble.
+    def detach(self):
+        self.preamble=self.file.getvalue()
+        self.file=None
+        groups={}
+        images={}
+        for p in self.prims:
+            p.group=standin(p.group, groups)
+            p.image=standin(p.image, images)
+        regions={}
+        for img in self.regions.keys():
+            regions[standin(img, images)]=self.regions[img]
+        self.regions=regions
+        self.groups=[]
+        self.log=[(msg, None) for (msg, objs) in self.log]
+        self.detached=True
+
+    # Objects for an ExportError raised by writeCollected. A detached exporter
+    # may be in another process, so it names them and writeBatch looks them up.
+    def errorObjects(self, names):
+        if self.detached:
+            return names
+        return namedObjects(names)
+
+    #------------------------------------------------------------------------
+    # Everything else - sort, build indices and write
+    def writeCollected (self):
+
+        if self.layermask==1:
+            lseq=[1]
+        else:
+            lseq=[1,2,4]
+
         #------------------------------------------------------------------------
         # STATE SORT
         #------------------------------------------------------------------------
@@ -718,7 +1084,6 @@ class OBJexport8:
         # "just 1" is good enough to get the critical effect: not reordering
         # layer 1 items by their other-layer membership.
         for p in self.prims:
-            p.cache(self.vt)
             if p.layer & 1:
                 p.layer_now = 1
             else:
@@ -727,7 +1092,7 @@ class OBJexport8:
         # This is what munges the OBJ order.  Prims contains everything we want
         # to output, tagged with state.  Now we will have it in the order we want
         # to write the file.
-        self.prims.sort()
+        sort_prims(self.prims, self.vt, state_order(self.state_weights))
 
         # Post-sort opacity optimization: when a face is officially "opaque" the author
         # is declaring that they don't _care_ what alpha we use, because the face doesn't
@@ -758,10 +1123,10 @@ class OBJexport8:
                         cur_alpha = p.alpha
                         if cur_alpha != first_interesting_alpha:
                             if self.instanced:
-                                 raise ExportError("Object %s:|You have requested instancing but you are using multiple blending modes.|There is a conflict between %s and %s." % (self.filename, first_interesting_alpha_name, p.debug_name))
+                                 raise ExportError("Object %s:|You have requested instancing but you are using multiple blending modes.|There is a conflict between %s and %s." % (self.filename, first_interesting_alpha_name, p.debug_name), self.errorObjects([first_interesting_alpha_name, p.debug_name]))
             if self.instanced:
                 if self.global_alpha != first_interesting_alpha and self.global_alpha[0] != Prim.BLEND:
-                    raise ExportError("Object %s:|The alpha specified by your buttons do not match your global blending attributes."% self.filename)
+                    raise ExportError("Object %s:|The alpha specified by your buttons do not match your global blending attributes."% self.filename, self.errorObjects([first_interesting_alpha_name]))
                 # if we wanted to warn about ununsed global attributes for blending we'd do it here!
                 self.global_alpha = first_interesting_alpha
 
@@ -789,25 +1154,16 @@ class OBJexport8:
         # to get lines after lights. (Q: does x-plane really care?)  We could
         # do lights with lines for more speed.
 
-        indices=[]
-        progress=0.0
-        for tri in self.prims:
-            if tri.style=='Tri':
-                tri.offset=len(indices)
-                indices.append(tri.i[0])
-                indices.append(tri.i[1])
-                indices.append(tri.i[2])
-                if len(tri.i)==4:    # quad
-                    indices.append(tri.i[0])
-                    indices.append(tri.i[2])
-                    indices.append(tri.i[3])
-                tri.count=len(indices)-tri.offset
-        for line in self.prims:
-            if line.style=='Line':
-                line.offset=len(indices)
-                indices.append(line.i[0])
-                indices.append(line.i[1])
-                line.count=len(indices)-line.offset
+        indices=self.buildIndices()
+
+        #------------------------------------------------------------------------
+        # VERTEX CACHE OPTIMISATION
+        #------------------------------------------------------------------------
+        # Optionally reorder the tris within each run of identical state for
+        # the GPU's post-transform vertex cache, and renumber the VTs into the
+        # order that they're first used.
+        if self.vertex_cache:
+            indices=self.optimiseIndices(indices)
 
         # Lights
         for light in self.prims:
@@ -824,28 +1180,8 @@ class OBJexport8:
                                                            len(self.vline),
                                                            len(self.vlights),
                                                            len(indices)))
-        Window.DrawProgressBar(0.8, 'Exporting 80% ...')
-        for vt in self.vt:
-            self.file.write("VT\t%s\n" % vt)
-        if self.vt:
-            self.file.write("\n")
-
-        for vline in self.vline:
-            self.file.write("VLINE\t%s\n" % vline)
-        if self.vline:
-            self.file.write("\n")
-
-        for light in self.vlights:
-            self.file.write("VLIGHT\t%s\n" % light.i)
-        if self.vlights:
-            self.file.write("\n")
-
-        Window.DrawProgressBar(0.9, 'Exporting 90% ...')
-        n=len(indices)
-        for i in range(0, n-9, 10):
-            self.file.write("IDX10\t"+' '.join([str(j) for j in indices[i:i+10]])+"\n")
-        for i in range(n-(n%10), n):
-            self.file.write("IDX\t%d\n" % indices[i])
+        if not self.detached: Window.DrawProgressBar(0.8, 'Exporting 80% ...')
+        write_tables(self.file, self.vt, self.vline, [light.i for light in self.vlights], indices)
 
         if self.slung:
             self.file.write("\nslung_load_weight\t%s\n" % self.slung)
@@ -864,6 +1200,8 @@ class OBJexport8:
         # pulling out all the lines from tris, etc. which will mean LODs
         # get duplicated (which is illegal!)
 
+        counter=StateCounter(self.file)
+        self.file=counter
         for l in lseq:
             for prim in self.prims:
                 if prim.layer & l:
@@ -888,14 +1226,87 @@ class OBJexport8:
         # Close triangles in the final layer
         self.flush_prim()
         # Close animations in final layer
-        while not self.anim.equals(Anim(self, None)):
+        while not self.anim.isnull():
             self.anim=self.anim.anim
             self.file.write("%sANIM_end\n" % self.anim.ins())
+        self.file=counter.file
+        self.stats=counter.counts
+        if self.verbose:
+            print "Info:\t%s" % self.stateReport()
         self.file.close()
 
 #        if not n==len(offsets)==len(counts):
 #           raise ExportError('Bug - indices out of sync')
 
+    #------------------------------------------------------------------------
+    # Summary of the state changes and batches in the command table
+    def stateReport(self):
+        attrs=[(n,c) for (n,c) in self.stats.items() if n.startswith('ATTR_')]
+        attrs.sort()
+        return "%d attribute changes, %d ANIM_begin/end, %d TRIS, %d LINES, %d LIGHTS" % (
+            sum([c for (n,c) in attrs]),
+            self.stats.get('ANIM_begin',0),
+            self.stats.get('TRIS',0),
+            self.stats.get('LINES',0),
+            self.stats.get('LIGHTS',0)) + ''.join(["\n\t%-24s %d" % (n,c) for (n,c) in attrs])
+
+    #------------------------------------------------------------------------
+    # Build the master index list for tris followed by lines, in prim order
+    def buildIndices(self):
+        indices=[]
+        for tri in self.prims:
+            if tri.style=='Tri':
+                tri.offset=len(indices)
+                indices.append(tri.i[0])
+                indices.append(tri.i[1])
+                indices.append(tri.i[2])
+                if len(tri.i)==4:    # quad
+                    indices.append(tri.i[0])
+                    indices.append(tri.i[2])
+                    indices.append(tri.i[3])
+                tri.count=len(indices)-tri.offset
+        for line in self.prims:
+            if line.style=='Line':
+                line.offset=len(indices)
+                indices.append(line.i[0])
+                indices.append(line.i[1])
+                line.count=len(indices)-line.offset
+        return indices
+
+    #------------------------------------------------------------------------
+    # Reorder tris for the vertex cache and rebuild the master index list.
+    def optimiseIndices(self, indices):
+        ntri=0	# number of indices used by tris - these come first
+        for tri in self.prims:
+            if tri.style=='Tri':
+                ntri+=tri.count
+        if self.verbose:
+            before=acmr(indices[:ntri], self.vertex_cache)
+        reorder_prims(self.prims, self.vertex_cache)
+        indices=self.buildIndices()
+
+        # Renumber VTs in order of first use
+        remap=[-1]*len(self.vt)
+        vt=[]
+        for i in indices[:ntri]:
+            if remap[i]<0:
+                remap[i]=len(vt)
+                vt.append(self.vt[i])
+        for i in range(len(self.vt)):
+            if remap[i]<0:	# unused
+                remap[i]=len(vt)
+                vt.append(self.vt[i])
+        self.vt=vt
+        indices[:ntri]=[remap[i] for i in indices[:ntri]]
+        for tri in self.prims:
+            if tri.style=='Tri':
+                tri.i=[remap[i] for i in tri.i]
+
+        if self.verbose:
+            after=acmr(indices[:ntri], self.vertex_cache)
+            print "Info:\tVertex cache miss ratio %.3f before optimisation, %.3f after" % (before, after)
+        return indices
+
     #------------------------------------------------------------------------
     # SORTING LAMPS
     #------------------------------------------------------------------------
@@ -1070,7 +1481,7 @@ class OBJexport8:
             mesh.getFromObject(object)
 
         (anim, mm, aidx)=self.makeAnim(object)
-        hasanim=not anim.equals(Anim(self, None))
+        hasanim=not anim.isnull()
         nm=MatrixrotationOnly(mm, object)
         # Vertex order, taking into account negative scaling
         if object.SizeX*object.SizeY*object.SizeZ<0:
@@ -1119,23 +1530,108 @@ class OBJexport8:
         if has_prop(object,'up_norm') and int(get_prop(object,'up_norm','0')):
             up_nrm=True
 
-
-        # Optimisation: Children of animations might be dupes. This test only
-        # looks for exact duplicates, but this can reduce vertex count by ~10%.
+        # Face state that only depends on the object, or on the face's material
+        # or transparency mode, is worked out once and shared by all the faces.
+        manip=self.share('manip', decode(object))
+        lit_level=self.share('lit_level', lit_level)
+        draped=has_prop(object,'ATTR_draped')
+        hard=not self.iscockpit and (self.additive_lod or (object.Layer&1))
+        objflags=0
+        if draw_disable:
+            objflags|=Prim.DRAW_DISABLE
+        if solid_camera:
+            objflags|=Prim.SOLID_CAMERA
+        facemats={}	# material index -> (diffuse, emission, shiny)
+        alphas={}	# transparency mode -> alpha
+        regions={}	# image -> cockpit region index
+        for img in self.regions.keys():
+            regions[img]=len(regions)
         twosideerr=[]
         harderr=[]
         degenerr=[]
+
+        def makeFace(f, mode, n):
+            if f.mat<len(mats) and mats[f.mat]:
+                if not f.mat in facemats:
+                    material=mats[f.mat]
+                    # diffuse, emission, shiny
+                    facemats[f.mat]=self.share('mat', ((material.R, material.G, material.B),
+                                                       (material.mirR*material.emit,
+                                                        material.mirG*material.emit,
+                                                        material.mirB*material.emit), material.spec))
+                mat=facemats[f.mat]
+            else:
+                mat=DEFMAT
+            face=Prim(object, group, objflags, None, mat, safe_image_for_face(mesh,f), anim, aidx,'Tri')
+            face.manip=manip
+            face.lit_level=lit_level
+
+            if mode & Mesh.FaceModes.TEX:
+                if len(f.uv)!=n:
+                    raise ExportError('Missing UV for face in mesh "%s"' % object.name, (object, mesh, [f]))
+                if f.transp in [Mesh.FaceTranspModes.ALPHA, Mesh.FaceTranspModes.CLIP]:
+                    if not f.transp in alphas:
+                        if f.transp == Mesh.FaceTranspModes.ALPHA:
+                            if has_prop(object,'ATTR_shadow_blend'):
+                                alpha=[Prim.SHADOWTEST,round(float(get_prop(object,'ATTR_shadow_blend',0.5)),2)]
+                            elif has_prop(object,'GLOBAL_shadow_blend'):
+                                alpha=[Prim.SHADOWTEST,round(float(get_prop(object,'GLOBAL_shadow_blend',0.5)),2)]
+                            else:
+                                alpha=[Prim.BLEND,0.0]
+                        else:
+                            if has_prop(object,'ATTR_no_blend'):
+                                alpha=[Prim.TEST,round(float(get_prop(object,'ATTR_no_blend',0.5)),2)]
+                            elif has_prop(object,'GLOBAL_no_blend'):
+                                alpha=[Prim.TEST,round(float(get_prop(object,'GLOBAL_no_blend',0.5)),2)]
+                            else:
+                                alpha=[Prim.TEST,0.5]
+                        alphas[f.transp]=self.share('alpha', alpha)
+                    face.alpha=alphas[f.transp]
+
+            if mode & Mesh.FaceModes.TWOSIDE:
+                face.flags|=Prim.TWOSIDE
+                twosideerr.append(f)
+
+            if not mode&(Mesh.FaceModes.TILES|Mesh.FaceModes.LIGHT) or self.iscockpit:
+                face.flags|=Prim.NPOLY
+            elif draped:
+                face.flags|=(Prim.DRAPED|Prim.NPOLY)
+
+            if self.ispanelok and mode&Mesh.FaceModes.TEX:
+                if f.image in regions:
+                    face.flags|=Prim.PANEL
+                    face.region=regions[f.image]
+                elif f.image and 'panel.' in f.image.name.lower():
+                    face.flags|=Prim.PANEL
+
+            if hard and not mode&Mesh.FaceModes.DYNAMIC:
+                face.flags|=hardness
+                face.surface=surface
+                harderr.append(f)
+
+            if mode&Mesh.FaceModes.SHADOW:
+                face.flags|=Prim.NSHADOW
+
+            # Special case: if panel-textured faces have _no_ manipulator, auto-apply the panel manipulator.
+            # use the fake name ATTR_manip_panel to mark what we're doing, since X-plane doesn't have a real attribute
+            # command for manipulators.
+            if face.flags&Prim.PANEL and face.manip == "":
+                face.manip="ATTR_manip_panel"
+
+            return face
+
+        # Optimisation: Children of animations might be dupes. This test only
+        # looks for exact duplicates, but this can reduce vertex count by ~10%.
         mode=Mesh.FaceModes.DYNAMIC
         if hasanim:
-            animcands=list(self.animcands)    # List of candidate tris
-            trino=0
-            fudge=Vertex.LIMIT*10        # Be more lenient
+            corners=[]	# VTs of each visible face, in the order that they're stored in the face
             for f in mesh.faces:
                 if mesh.faceUV: mode=f.mode
                 n=len(f.v)
                 if not n in [3,4]:
                     pass
                 elif not (mode & Mesh.FaceModes.INVISIBLE):
+                    vts=[]
                     for i in seq[n]:
                         nmv=f.verts[i]
                         vertex=Vertex(nmv.co[0], nmv.co[1], nmv.co[2], mm)
@@ -1149,20 +1645,14 @@ class OBJexport8:
                             uv=UV(f.uv[i][0], f.uv[i][1])
                         else:    # File format requires something - using (0,0)
                             uv=UV(0,0)
-                        vt=VT(vertex, norm, uv)
-
-                        j=0
-                        while j<len(animcands):
-                            if not vt.equals(self.vt[self.prims[animcands[j]+trino].i[seq[n][i]]], fudge):
-                                animcands.pop(j)    # no longer a candidate
-                            else:
-                                j=j+1
-
-                    if not len(animcands):
-                        break    # exhausted candidates
-                    trino+=1
-            else:
-                # Success - re-use tris starting at self.vt[animcands[0]]
+                        vts.append(VT(vertex, norm, uv))
+                    corners.append(vts)
+            reuse=None
+            for starttri in self.animindex.find(corners):
+                if self.matchesAnim(starttri, corners) and (reuse==None or starttri<reuse):
+                    reuse=starttri
+            if reuse!=None:
+                # Success - re-use tris starting at self.prims[reuse]
                 trino=0
                 for f in mesh.faces:
                     if mesh.faceUV: mode=f.mode
@@ -1170,74 +1660,9 @@ class OBJexport8:
                     if not n in [3,4]:
                         degenerr.append(f)
                     elif not (mode & Mesh.FaceModes.INVISIBLE):
-                        if f.mat<len(mats) and mats[f.mat]:
-                            material=mats[f.mat]
-                            # diffuse, emission, shiny
-                            mat=((material.R, material.G, material.B),
-                                 (material.mirR*material.emit,
-                                  material.mirG*material.emit,
-                                  material.mirB*material.emit), material.spec)
-#                            if not mat in self.mats: self.mats.append(mat)
-                        else:
-                            mat=DEFMAT
-                        face=Prim(object, group, 0, None, mat, safe_image_for_face(mesh,f), anim, aidx,'Tri')
-                        face.manip = decode(object)
-
-                        if mode & Mesh.FaceModes.TEX:
-                            if len(f.uv)!=n:
-                                raise ExportError('Missing UV in mesh "%s"' % object.name, [object])
-                            if f.transp == Mesh.FaceTranspModes.ALPHA:
-                                if has_prop(object,'ATTR_shadow_blend'):
-                                    face.alpha=[Prim.SHADOWTEST,round(float(get_prop(object,'ATTR_shadow_blend',0.5)),2)]
-                                elif has_prop(object,'GLOBAL_shadow_blend'):
-                                    face.alpha=[Prim.SHADOWTEST,round(float(get_prop(object,'GLOBAL_shadow_blend',0.5)),2)]
-                                else:
-                                    face.alpha=[Prim.BLEND,0.0]
-                            if f.transp == Mesh.FaceTranspModes.CLIP:
-                                if has_prop(object,'ATTR_no_blend'):
-                                    face.alpha=[Prim.TEST,round(float(get_prop(object,'ATTR_no_blend',0.5)),2)]
-                                elif has_prop(object,'GLOBAL_no_blend'):
-                                    face.alpha=[Prim.TEST,round(float(get_prop(object,'GLOBAL_no_blend',0.5)),2)]
-                                else:
-                                    face.alpha=[Prim.TEST,0.5]
-
-                        if mode & Mesh.FaceModes.TWOSIDE:
-                            face.flags|=Prim.TWOSIDE
-                            twosideerr.append(f)
-
-                        if not mode&(Mesh.FaceModes.TILES|Mesh.FaceModes.LIGHT) or self.iscockpit:
-                            face.flags|=Prim.NPOLY
-                        elif has_prop(object,'ATTR_draped'):
-                            face.flags|=(Prim.DRAPED|Prim.NPOLY)
-
-                        if self.ispanelok and mode&Mesh.FaceModes.TEX:
-                            if f.image in self.regions:
-                                face.flags=(face.flags|Prim.PANEL)&~Prim.ALPHA
-                                face.region=self.regions.keys().index(f.image)
-                            elif f.image and 'panel.' in f.image.name.lower():
-                                face.flags|=Prim.PANEL
-
-                        if not self.iscockpit and (self.additive_lod or (object.Layer&1)) and not mode&Mesh.FaceModes.DYNAMIC:
-                            face.flags|=hardness
-                            face.surface=surface
-                            harderr.append(f)
-                        if mode&Mesh.FaceModes.SHADOW:
-                            face.flags|=Prim.NSHADOW
-
-                        face.lit_level = lit_level
-                        if draw_disable:
-                            face.flags|=Prim.DRAW_DISABLE
-                        if solid_camera:
-                            face.flags|=Prim.SOLID_CAMERA
-
-                        # Special case: if panel-textured faces have _no_ manipulator, auto-apply the panel manipulator.
-                        # use the fake name ATTR_manip_panel to mark what we're doing, since X-plane doesn't have a real attribute
-                        # command for manipulators.
-                        if face.flags&Prim.PANEL and face.manip == "":
-                            face.manip="ATTR_manip_panel"
-
+                        face=makeFace(f, mode, n)
                         for i in range(n):
-                            face.i.append(self.prims[animcands[0]+trino].i[i])
+                            face.i.append(self.prims[reuse+trino].i[i])
 
                         self.prims.append(face)
                         trino+=1
@@ -1256,7 +1681,7 @@ class OBJexport8:
         # Either no animation, or no matching animation
         starttri=len(self.prims)
         # Optimisation: Build list of faces and vertices
-        vti = [[] for i in range(len(mesh.verts))]    # indices into vt
+        vti = VTIndex(self.vt)    # indices into vt, by mesh vertex
 
         for f in mesh.faces:
             if mesh.faceUV: mode=f.mode
@@ -1264,71 +1689,7 @@ class OBJexport8:
             if not n in [3,4]:
                 degenerr.append(f)
             elif not (mode & Mesh.FaceModes.INVISIBLE):
-                if f.mat<len(mats) and mats[f.mat]:
-                    material=mats[f.mat]
-                    # diffuse, emission, shiny
-                    mat=((material.R, material.G, material.B),
-                         (material.mirR*material.emit,
-                          material.mirG*material.emit,
-                          material.mirB*material.emit), material.spec)
-#                    if not mat in self.mats: self.mats.append(mat)
-                else:
-                    mat=DEFMAT
-                face=Prim(object, group, 0, None, mat, safe_image_for_face(mesh,f), anim, aidx,'Tri')
-                face.manip = decode(object)
-
-                if mode & Mesh.FaceModes.TEX:
-                    if len(f.uv)!=n:
-                        raise ExportError('Missing UV for face in mesh "%s"' % object.name, (object, mesh, [f]))
-                    if f.transp == Mesh.FaceTranspModes.ALPHA:
-                        if has_prop(object,'ATTR_shadow_blend'):
-                            face.alpha=[Prim.SHADOWTEST,round(float(get_prop(object,'ATTR_shadow_blend',0.5)),2)]
-                        elif has_prop(object,'GLOBAL_shadow_blend'):
-                            face.alpha=[Prim.SHADOWTEST,round(float(get_prop(object,'GLOBAL_shadow_blend',0.5)),2)]
-                        else:
-                            face.alpha=[Prim.BLEND,0.0]
-                    if f.transp == Mesh.FaceTranspModes.CLIP:
-                        if has_prop(object,'ATTR_no_blend'):
-                            face.alpha=[Prim.TEST,round(float(get_prop(object,'ATTR_no_blend',0.5)),2)]
-                        elif has_prop(object,'GLOBAL_no_blend'):
-                            face.alpha=[Prim.TEST,round(float(get_prop(object,'GLOBAL_no_blend',0.5)),2)]
-                        else:
-                            face.alpha=[Prim.TEST,0.5]
-
-                if mode & Mesh.FaceModes.TWOSIDE:
-                    face.flags|=Prim.TWOSIDE
-                    twosideerr.append(f)
-
-                if not mode&(Mesh.FaceModes.TILES|Mesh.FaceModes.LIGHT) or self.iscockpit:
-                    face.flags|=Prim.NPOLY
-                elif has_prop(object,'ATTR_draped'):
-                    face.flags|=(Prim.DRAPED|Prim.NPOLY)
-
-                if self.ispanelok and mode&Mesh.FaceModes.TEX:
-                    if f.image in self.regions:
-                        face.flags=(face.flags|Prim.PANEL)&~Prim.ALPHA
-                        face.region=self.regions.keys().index(f.image)
-                    elif f.image and 'panel.' in f.image.name.lower():
-                        face.flags|=Prim.PANEL
-
-                if not self.iscockpit and (self.additive_lod or (object.Layer&1)) and not mode&Mesh.FaceModes.DYNAMIC:
-                    face.flags|=hardness
-                    face.surface=surface
-                    harderr.append(f)
-
-                if mode&Mesh.FaceModes.SHADOW:
-                    face.flags|=Prim.NSHADOW
-
-
-                if face.flags&Prim.PANEL and face.manip == "":
-                    face.manip="ATTR_manip_panel"
-
-                face.lit_level = lit_level
-                if draw_disable:
-                    face.flags|=Prim.DRAW_DISABLE
-                if solid_camera:
-                    face.flags|=Prim.SOLID_CAMERA
-
+                face=makeFace(f, mode, n)
                 for i in seq[n]:
                     nmv=f.verts[i]
                     vertex=Vertex(nmv.co[0], nmv.co[1], nmv.co[2], mm)
@@ -1349,18 +1710,14 @@ class OBJexport8:
                     # for one mesh vertex?  Simple: each face an have its own UV coord but
                     # vertices are shared in Blender.  So mostly the 'doubling' of vertices will
 
-                    #for j in range(len(self.vt)):    # Search all meshes
-                    for j in vti[nmv.index]:        # Search this vertex
-                        q=self.vt[j]
-                        if vt.equals(q):
-                            q.uv= (q.uv+ vt.uv)/2
-                            face.i.append(j)
-                            break
+                    j=vti.find(nmv.index, vt)    # Search this vertex
+                    if j!=None:
+                        vti.weld(nmv.index, j, vt)
                     else:
                         j=len(self.vt)
                         self.vt.append(vt)
-                        face.i.append(j)
-                        vti[nmv.index].append(j)
+                        vti.add(nmv.index, j)
+                    face.i.append(j)
 
                 self.prims.append(face)
 
@@ -1368,7 +1725,7 @@ class OBJexport8:
 
         if hasanim:
             # Save tris for matching next
-            self.animcands.append(starttri)
+            self.animindex.add(corners, starttri)
 
         if degenerr and self.verbose:
             print 'Info:\tIgnoring %s degenerate face(s) in mesh "%s"' % (len(degenerr), object.name)
@@ -1381,6 +1738,36 @@ class OBJexport8:
             self.log.append(('Found %s two-sided face(s) in mesh "%s"' % (len(twosideerr), object.name), (object, mesh, twosideerr)))
 
 
+    #------------------------------------------------------------------------
+    # Do the tris starting at self.prims[starttri] have the same geometry as
+    # a mesh's visible faces?  Be more lenient than when welding VTs.
+    def matchesAnim(self, starttri, corners):
+        if starttri+len(corners)>len(self.prims):
+            return False
+        fudge=ANIM_LIMIT
+        for trino in range(len(corners)):
+            face=self.prims[starttri+trino]
+            vts=corners[trino]
+            if face.style!='Tri' or len(face.i)!=len(vts):
+                return False
+            for i in range(len(vts)):
+                if not vts[i].equals(self.vt[face.i[i]], fudge):
+                    return False
+        return True
+
+    #------------------------------------------------------------------------
+    # Returns the first value of this kind equal to value that was passed in,
+    # so that prims share equal attribute values rather than holding copies.
+    def share(self, kind, value):
+        if isinstance(value, list):
+            key=(kind, tuple(value))
+        else:
+            key=(kind, value)
+        if key in self.shared:
+            return self.shared[key]
+        self.shared[key]=value
+        return value
+
     #------------------------------------------------------------------------
     # Return name of group that this object belongs to
     def findgroup(self, ob):
@@ -1400,7 +1787,7 @@ class OBJexport8:
         # Add parent anims first
         al=[]
         a=anim
-        while not a.equals(Anim(self, None)):
+        while not a.isnull():
             al.insert(0, a)
             a=a.anim
 
@@ -1419,6 +1806,7 @@ class OBJexport8:
         else:
             mm=child.getMatrix('worldspace')
 
+        parent=self.anims[0]
         for a in al:
             # Hack!
             # We need the position of the child in bone space - ie
@@ -1449,19 +1837,23 @@ class OBJexport8:
                 print "post\t%s" % mm.rotationPart().toEuler()
                 print "\t%s" % mm.translationPart()
 
-            # Add Anim, but avoid dups
+            # Add Anim, but avoid dups. Parents have already been interned
+            # so only anims with the same parent need to be compared.
+            a.anim=parent
             for b in self.anims:
-                if a.equals(b):
+                if b.anim is parent and a.equals(b):
                     anim=b
                     break
             else:
+                a.intern(parent, len(self.anims))
                 self.anims.append(a)
                 anim=a	# The anim we just made is the last one in the list
+            parent=anim
 
-        if anim.equals(Anim(self,None)):
-            return (anim, mm, -1)
+        if anim.isnull():
+            return (self.anims[0], mm, -1)
         else:
-            return (anim, mm, self.anims.index(anim))
+            return (anim, mm, anim.index)
 
 
     #------------------------------------------------------------------------
@@ -1555,7 +1947,7 @@ class OBJexport8:
         if layer!=self.layer:
             # Reset all attributes
             self.flush_prim()
-            while not self.anim.equals(Anim(self, None)):
+            while not self.anim.isnull():
                 self.anim=self.anim.anim
                 self.writeAttr("%sANIM_end\n" % self.anim.ins())
 
@@ -1589,11 +1981,11 @@ class OBJexport8:
             olda=[]
             newa=[]
             a=self.anim
-            while not a.equals(Anim(self, None)):
+            while not a.isnull():
                 olda.insert(0, a)
                 a=a.anim
             a=anim
-            while not a.equals(Anim(self, None)):
+            while not a.isnull():
                 newa.insert(0, a)
                 a=a.anim
             for i in range(len(olda)-1,-1,-1):
@@ -1857,6 +2249,9 @@ class Anim:
         self.loop=0	# loop value (XPlane 9)
         self.showhide=[]	# show/hide values (show/hide, name, v1, v2)
         self.anim=None	# parent Anim
+        self.index=None	# position in the exporter's list of anims once interned, see intern()
+        self.depth=None	# number of non-null anims in the chain, once interned
+        self.indent=None	# ins() once interned
 
         if not child:
             return	# null
@@ -2035,7 +2430,7 @@ class Anim:
                      bone.matrix['ARMATURESPACE'].translationPart(),mm)
             # Child offset should be relative to parent
             anim=self.anim
-            while not anim.equals(Anim(expobj, None)):
+            while not anim.isnull():
                 t=t-anim.t[0]	# mesh location is relative to first frame
                 anim=anim.anim
             self.t.append(t)
@@ -2185,10 +2580,28 @@ class Anim:
         else:
             return "None"
 
+    #------------------------------------------------------------------------
+    # Called by the exporter when this anim is added to its list of unique
+    # anims. parent must already be interned.
+    def intern(self, parent, index):
+        self.index=index
+        if parent:
+            self.anim=parent
+            self.depth=parent.depth+1
+        else:
+            self.depth=0
+        self.indent="\t"*self.depth
+
+    #------------------------------------------------------------------------
+    def isnull(self):
+        return not self.dataref
+
     #------------------------------------------------------------------------
     def equals (self, b):
         if self is b:
             return True
+        if self.index!=None and b.index!=None:
+            return False	# interned anims are unique
         if not self.dataref:	# null
             return not b.dataref
         if (self.dataref!=b.dataref or
@@ -2213,14 +2626,134 @@ class Anim:
 
     #------------------------------------------------------------------------
     def ins(self):
+        if self.indent!=None:
+            return self.indent
         t=''
         anim=self
-        while not anim.equals(Anim(self, None)):
+        while not anim.isnull():
             t=t+"\t"
             anim=anim.anim
         return t
 
 
+#------------------------------------------------------------------------
+# Wraps the output file while the command table is written and counts the
+# commands written to it, so that orderings can be compared by the number of
+# state changes and batches that they produce.
+class StateCounter:
+    def __init__(self, file):
+        self.file=file
+        self.counts={}	# command -> number written
+
+    def write(self, s):
+        for line in s.split('\n'):
+            c=line.split(None, 1)
+            if c and not c[0].startswith('#'):
+                self.counts[c[0]]=self.counts.get(c[0],0)+1
+        self.file.write(s)
+
+
+#------------------------------------------------------------------------
+# Stand-in for a Blender Group or Image in a detached exporter. One per name,
+# so that comparing stand-ins behaves like comparing the originals.
+class Named:
+    def __init__(self, name):
+        self.name=name
+
+def standin(thing, names):
+    if thing==None:
+        return None
+    if not thing.name in names:
+        names[thing.name]=Named(thing.name)
+    return names[thing.name]
+
+
+# Names of the objects that an ExportError refers to, so that the error can
+# be passed back from a worker process.
+def objectNames(objs):
+    if not objs:
+        return None
+    if isinstance(objs, tuple):
+        objs=[objs[0]]	# (object, mesh, faces)
+    return [isinstance(o, str) and o or o.name for o in objs]
+
+def namedObjects(names):
+    objs=[]
+    for name in names or []:
+        try:
+            objs.append(Blender.Object.Get(name))
+        except ValueError:
+            pass	# since deleted
+    return objs
+
+
+#------------------------------------------------------------------------
+# Finish off a detached exporter. Returns (filename, number of primitives,
+# log messages, error message or None, names of the objects in error).
+def writeDetached(exporter):
+    try:
+        exporter.file=open(exporter.filename, 'w')
+        try:
+            exporter.file.write(exporter.preamble)
+            exporter.writeCollected()
+        finally:
+            exporter.file.close()
+    except ExportError, e:
+        return (exporter.filename, 0, [], e.msg, objectNames(e.objs))
+    except IOError, e:
+        return (exporter.filename, 0, [], e.strerror, None)
+    return (exporter.filename, exporter.nprim, [a[0] for a in exporter.log], None, None)
+
+# Whether writeBatch uses a pool of processes by default. Worker processes
+# are forked from Blender, which isn't safe on Mac OS X and isn't possible
+# on Windows.
+PARALLEL_EXPORT=(osname=='posix' and sys.platform!='darwin')
+
+# How many detached exporters XPlaneMultiObj collects before writing them.
+BATCH_SIZE=32
+
+# Write out a list of detached exporters, using a pool of processes if
+# parallel is set and we can. Otherwise, and on Windows and on Pythons
+# before 2.6, they are written one at a time. The exporters are handed to
+# the pool a few at a time, and writing stops after the first few that
+# include an error. Raises ExportError for the first error.
+def writeBatch(exporters, processes=None, parallel=PARALLEL_EXPORT):
+    pool=None
+    size=1
+    if parallel and len(exporters)>1 and multiprocessing and osname=='posix':
+        try:
+            processes=processes or multiprocessing.cpu_count()
+            pool=multiprocessing.Pool(processes)
+            size=processes*2
+        except (OSError, NotImplementedError):
+            pass
+    results=[]
+    try:
+        for i in range(0, len(exporters), size):
+            chunk=exporters[i:i+size]
+            done=[]
+            if pool:
+                it=pool.imap_unordered(writeDetached, chunk)
+                for j in range(len(chunk)):
+                    try:
+                        done.append(it.next())
+                    except (PicklingError, TypeError):
+                        pass	# holds something that can't be pickled - written below instead
+            written=[r[0] for r in done]
+            for exporter in chunk:
+                if not exporter.filename in written:
+                    done.append(writeDetached(exporter))
+            results.extend(done)
+            for (filename, nprim, log, error, names) in done:
+                if error:
+                    raise ExportError(error, namedObjects(names))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return results
+
+
 #------------------------------------------------------------------------
 def getcustomdataref(object, child, thing, names):
     dataref=None
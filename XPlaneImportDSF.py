@@ -22,13 +22,18 @@ This script imports X-Plane DSF terrain.
 # See ReadMe-XPlane2Blender.html for usage.
 #
 
+import Blender
 from Blender import Draw, Window, Image, Lamp, Material, Mesh, Object, Scene, Texture
 from Blender.Mathutils import Vector
 
 from math import cos, pi, radians
+from glob import glob
 from os import listdir, walk
 from os.path import abspath, basename, dirname, exists, isdir, join, pardir, normpath
-from struct import unpack
+from re import match
+
+from XPlaneImportDSF_util import DSFcache, TERcache, decodeTile, decodeTiles, patchLists
+from XPlaneLibIndex import getindex
 
 hscale=1000
 vscale=1.0/100
@@ -36,342 +41,83 @@ resolution=8*65535
 minres=1.0/resolution
 
 libterrain={}
+images={}	# texture path -> Image, shared by all the patches that use it
 
 
-def readDSF(path):
-    baddsf=(0, "Invalid DSF file", path)
-
-    h=file(path, 'rb')
-    h.seek(0, 2)
-    hlen=h.tell()
-    h.seek(0, 0)
-    if h.read(8)!='XPLNEDSF' or unpack('<I',h.read(4))!=(1,) or h.read(4)!='DAEH':
-        raise IOError, baddsf
-    (l,)=unpack('<I', h.read(4))
-    headend=h.tell()+l-8
-    if h.read(4)!='PORP':
-        raise IOError, baddsf
-    (l,)=unpack('<I', h.read(4))
-    properties=[]
-    c=h.read(l-9).split('\0')
-    h.read(1)
-    overlay=0
-    for i in range(0, len(c)-1, 2):
-        if c[i]=='sim/overlay': overlay=int(c[i+1])
-        elif c[i]=='sim/south': lat=int(c[i+1])
-        elif c[i]=='sim/west': lon=int(c[i+1])
-        properties.append((c[i],c[i+1]))
-    h.seek(headend)
-    if overlay:
-        # Overlay DSF - bail early
-        h.close()
-        raise IOError, (0, "This is an overlay DSF", path)
-
-    # Definitions Atom
-    if h.read(4)!='NFED':
-        raise IOError, baddsf
-    (l,)=unpack('<I', h.read(4))
-    defnend=h.tell()+l-8
-    terrain=objects=polygons=network=[]
-    while h.tell()<defnend:
-        c=h.read(4)
-        (l,)=unpack('<I', h.read(4))
-        if l==8:
-            pass	# empty
-        elif c=='TRET':
-            terrain=h.read(l-9).replace('\\','/').replace(':','/').split('\0')
-            h.read(1)
-        elif c=='TJBO':
-            objects=h.read(l-9).replace('\\','/').replace(':','/').split('\0')
-            h.read(1)
-        elif c=='YLOP':
-            polygons=h.read(l-9).replace('\\','/').replace(':','/').split('\0')
-            h.read(1)
-        elif c=='WTEN':
-            networks=h.read(l-9).replace('\\','/').replace(':','/').split('\0')
-            h.read(1)
-        else:
-            h.seek(l-8, 1)
-
-    # Geodata Atom
-    if h.read(4)!='DOEG':
-        raise IOError, baddsf
-    (l,)=unpack('<I', h.read(4))
-    geodend=h.tell()+l-8
-    pool=[]
-    scal=[]
-    while h.tell()<geodend:
-        c=h.read(4)
-        (l,)=unpack('<I', h.read(4))
-        if c=='LOOP':
-            thispool=[]
-            (n,)=unpack('<I', h.read(4))
-            (p,)=unpack('<B', h.read(1))
-            for i in range(p):
-                thisplane=[]
-                (e,)=unpack('<B', h.read(1))
-                if e==0 or e==1:
-                    last=0
-                    for j in range(n):
-                        (d,)=unpack('<H', h.read(2))
-                        if e==1: d=(last+d)&65535
-                        thisplane.append(d)
-                        last=d
-                elif e==2 or e==3:
-                    last=0
-                    while(len(thisplane))<n:
-                        (r,)=unpack('<B', h.read(1))
-                        if (r&128):
-                            (d,)=unpack('<H', h.read(2))
-                            for j in range(r&127):
-                                if e==3:
-                                    thisplane.append((last+d)&65535)
-                                    last=(last+d)&65535
-                                else:
-                                    thisplane.append(d)
-                        else:
-                            for j in range(r):
-                                (d,)=unpack('<H', h.read(2))
-                                if e==3: d=(last+d)&65535
-                                thisplane.append(d)
-                                last=d
-                else:
-                    raise IOError, baddsf
-                thispool.append(thisplane)
-            pool.append(thispool)
-        elif c=='LACS':
-            thisscal=[]
-            for i in range(0, l-8, 8):
-                d=unpack('<2f', h.read(8))
-                thisscal.append(d)
-            scal.append(thisscal)
-        else:
-            h.seek(l-8, 1)
-
-    # Rescale pool and transform to one list per entry
-    if len(scal)!=len(pool): raise(IOError)
-    newpool=[]
-    for i in range(len(pool)):
-        curpool=pool[i]
-        n=len(curpool[0])
-        newpool=[[] for j in range(n)]
-        for plane in range(len(curpool)):
-            (scale,offset)=scal[i][plane]
-            scale=scale/65535
-            for j in range(n):
-                newpool[j].append(curpool[plane][j]*scale+offset)
-        pool[i]=newpool
-
-    # Commands Atom
-    if h.read(4)!='SDMC':
-        raise IOError, baddsf
-    (l,)=unpack('<I', h.read(4))
-    cmdsend=h.tell()+l-8
-    curpool=0
-    idx=0
-    near=0
-    far=-1
-    flags=0	# 0=physical, 1=overlay
-    f=[[[],[]] for i in range(len(terrain))]
-    v=[[[],[]] for i in range(len(terrain))]
-    t=[[[],[]] for i in range(len(terrain))]
-    pscale=99.0/(hlen-geodend)
-    progress=0
-    while h.tell()<cmdsend:
-        now=int((h.tell()-geodend)*pscale)
-        if progress!=now:
-            progress=now
-            Window.DrawProgressBar(progress/100.0, "Importing %2d%%"%progress)
-
-        (c,)=unpack('<B', h.read(1))
-        if c==1:	# Coordinate Pool Select
-            (curpool,)=unpack('<H', h.read(2))
-
-        elif c==2:	# Junction Offset Select
-            h.read(4)	# not implemented
-
-        elif c==3:	# Set Definition
-            (idx,)=unpack('<B', h.read(1))
-
-        elif c==4:	# Set Definition
-            (idx,)=unpack('<H', h.read(2))
-
-        elif c==5:	# Set Definition
-            (idx,)=unpack('<I', h.read(4))
-
-        elif c==6:	# Set Road Subtype
-            h.read(1)	# not implemented
-
-        elif c==7:	# Object
-            h.read(2)	# not implemented
-
-        elif c==8:	# Object Range
-            h.read(4)	# not implemented
-
-        elif c==9:	# Network Chain
-            (l,)=unpack('<B', h.read(1))
-            h.read(l*2)	# not implemented
-
-        elif c==10:	# Network Chain Range
-            h.read(4)	# not implemented
-
-        elif c==11:	# Network Chain
-            (l,)=unpack('<B', h.read(1))
-            h.read(l*4)	# not implemented
-
-        elif c==12:	# Polygon
-            (param,l)=unpack('<HB', h.read(3))
-            h.read(l*2)	# not implemented
-
-        elif c==13:	# Polygon Range (DSF2Text uses this one)
-            (param,first,last)=unpack('<HHH', h.read(6))	# not implemented
-
-        elif c==14:	# Nested Polygon
-            (param,n)=unpack('<HB', h.read(3))
-            for i in range(n):
-                (l,)=unpack('<B', h.read(1))
-                h.read(l*2)	# not implemented
-
-        elif c==15:	# Nested Polygon Range (DSF2Text uses this one too)
-            (param,n)=unpack('<HB', h.read(3))
-            h.read((n+1)*2)	# not implemented
-
-        elif c==16:	# Terrain Patch
-            pass
-
-        elif c==17:	# Terrain Patch w/ flags
-            (flags,)=unpack('<B', h.read(1))
-            flags-=1
-
-        elif c==18:	# Terrain Patch w/ flags & LOD
-            (flags,near,far)=unpack('<Bff', h.read(9))
-            flags-=1
-
-        elif c==23:	# Patch Triangle
-            (l,)=unpack('<B', h.read(1))
-            n=len(v[idx][flags])
-            for i in range(n,n+l,3):
-                f[idx][flags].append([i+2,i+1,i])
-            for i in range(l):
-                (d,)=unpack('<H', h.read(2))
-                p=pool[curpool][d]
-                v[idx][flags].append([(p[0]-lon)*hscale,
-                                      (p[1]-lat)*hscale, p[2]*vscale])
-                if len(p)>=7:
-                    t[idx][flags].append([p[5],p[6]])
-
-
-        elif c==24:	# Patch Triangle - cross-pool
-            (l,)=unpack('<B', h.read(1))
-            n=len(v[idx][flags])
-            for i in range(n,n+l,3):
-                f[idx][flags].append([i+2,i+1,i])
-            for i in range(l):
-                (c,d)=unpack('<HH', h.read(4))
-                p=pool[c][d]
-                v[idx][flags].append([(p[0]-lon)*hscale,
-                                      (p[1]-lat)*hscale, p[2]*vscale])
-                if len(p)>=7:
-                    t[idx][flags].append([p[5],p[6]])
-
-        elif c==25:	# Patch Triangle Range
-            (first,last)=unpack('<HH', h.read(4))
-            n=len(v[idx][flags])
-            for i in range(n,n+last-first,3):
-                f[idx][flags].append([i+2,i+1,i])
-            for d in range(first,last):
-                p=pool[curpool][d]
-                v[idx][flags].append([(p[0]-lon)*hscale,
-                                      (p[1]-lat)*hscale, p[2]*vscale])
-                if len(p)>=7:
-                    t[idx][flags].append([p[5],p[6]])
-
-        #elif c==26:	# Patch Triangle Strip (not used by DSF2Text)
-        #elif c==27:
-        #elif c==28:
-
-        elif c==29:	# Patch Triangle Fan
-            (l,)=unpack('<B', h.read(1))
-            n=len(v[idx][flags])
-            for i in range(1,l-1):
-                f[idx][flags].append([n+i+1,n+i,n])
-            for i in range(l):
-                (d,)=unpack('<H', h.read(2))
-                p=pool[curpool][d]
-                v[idx][flags].append([(p[0]-lon)*hscale,
-                                      (p[1]-lat)*hscale, p[2]*vscale])
-                if len(p)>=7:
-                    t[idx][flags].append([p[5],p[6]])
-
-        elif c==30:	# Patch Triangle Fan - cross-pool
-            (l,)=unpack('<B', h.read(1))
-            n=len(v[idx][flags])
-            for i in range(1,l-1):
-                f[idx][flags].append([n+i+1,n+i,n])
-            for i in range(l):
-                (c,d)=unpack('<HH', h.read(4))
-                p=pool[c][d]
-                v[idx][flags].append([(p[0]-lon)*hscale,
-                                      (p[1]-lat)*hscale, p[2]*vscale])
-                if len(p)>=7:
-                    t[idx][flags].append([p[5],p[6]])
-
-        elif c==31:	# Patch Triangle Fan Range
-            (first,last)=unpack('<HH', h.read(4))
-            n=len(v[idx][flags])
-            for i in range(1,last-first-1):
-                f[idx][flags].append([n+i+1,n+i,n])
-            for d in range(first, last):
-                p=pool[curpool][d]
-                v[idx][flags].append([(p[0]-lon)*hscale,
-                                      (p[1]-lat)*hscale, p[2]*vscale])
-                if len(p)>=7:
-                    t[idx][flags].append([p[5],p[6]])
-
-        elif c==32:	# Comment
-            (l,)=unpack('<B', h.read(1))
-            h.read(l)
-
-        elif c==33:	# Comment
-            (l,)=unpack('<H', h.read(2))
-            h.read(l)
-
-        elif c==34:	# Comment
-            (l,)=unpack('<I', h.read(4))
-            h.read(l)
+# bounds is (west, south, east, north) in degrees, or None for the whole tile.
+# lod is the maximum viewing distance in metres, or None for all patches.
+def readDSF(path, bounds=None, lod=None):
+    readDSFs([path], bounds, lod)
 
-        else:
-            raise IOError, (c, "Unrecognised command (%d)" % c, c)
 
-    h.close()
+# Import several tiles, placed relative to the first. Tiles that aren't
+# cached are decoded, in parallel if asked, then added to the scene one by
+# one.
+def readDSFs(paths, bounds=None, lod=None, parallel=False):
+    # Decoded tiles and terrain definitions are cached, since the same tile tends to be imported repeatedly
+    if Blender.Get('tempdir'):
+        cache=DSFcache(join(Blender.Get('tempdir'), 'XPlane2Blender.dsfcache'))
+        ters=TERcache(join(Blender.Get('tempdir'), 'XPlane2Blender.tercache'))
+    else:
+        cache=None
+        ters=TERcache()
+    tiles={}
+    keys={}
+    if cache:
+        for path in paths:
+            keys[path]=cache.key(path, bounds, lod, hscale, vscale)
+            tiles[path]=cache.get(keys[path])
+    todo=[path for path in paths if not tiles.get(path)]
+    if len(todo)==1:
+        tiles[todo[0]]=decodeTile(todo[0], bounds, lod, hscale, vscale,
+                                  lambda progress: Window.DrawProgressBar(progress/100.0, "Importing %2d%%"%progress))
+    elif todo:
+        Window.DrawProgressBar(0, "Importing %d tiles" % len(todo))
+        tiles.update(zip(todo, decodeTiles([(path, bounds, lod, hscale, vscale) for path in todo], parallel=parallel)))
+    if cache:
+        for path in todo:
+            cache.put(keys[path], tiles[path])
 
     Window.DrawProgressBar(0.99, "Realising")
 
     scene=Scene.GetCurrent()
     scene.layers=[1,2]
 
+    (west0, south0)=tiles[paths[0]][:2]
+    for path in paths:
+        (west, south, terrain, patches)=tiles.pop(path)
+        addTile(scene, path, terrain, patches, (west-west0)*hscale, (south-south0)*hscale, ters)
+    ters.save()
+
+    lamp=Lamp.New("Lamp", "Sun")
+    ob = Object.New("Lamp", "Sun")
+    ob.link(lamp)
+    scene.objects.link(ob)
+    lamp.type=1
+    ob.Layer=3
+    ob.setLocation(500, 500, 1000)
+
+
+#------------------------------------------------------------------------
+# Add the meshes for a tile's patches, as returned by decodeTile, to the
+# scene with their origin at (x,y)
+def addTile(scene, path, terrain, patches, x, y, ters):
+    patches=dict([((idx,flags), (v,f,t)) for (idx,flags,v,f,t) in patches])
     for flags in [0]:# was [1,0]:	# overlay first so overlays
         for idx in range(len(terrain)):
-            if not f[idx][flags]: continue
+            if not (idx,flags) in patches: continue
+            (v,f,t)=patchLists(*patches.pop((idx,flags)))
             if idx:
                 name=basename(terrain[idx])[:-4]
                 if flags: name=name+'.2'
-                if terrain[idx] in libterrain:
-                    (texture, angle, xscale, zscale)=readTER(libterrain[terrain[idx]])
-                elif exists(join(dirname(path), pardir, pardir, terrain[idx])):
-                    (texture, angle, xscale, zscale)=readTER(abspath(join(dirname(path), pardir, pardir, terrain[idx])))
-                else:
-                    raise IOError(0, 'Terrain %s not found' % terrain[idx], terrain[idx])
+                (texture, angle, xscale, zscale)=getTerrain(ters, terrain[idx], path)
+                img=getImage(texture)
                 try:
                     mat=Material.Get(name)
                 except:
                     mat=Material.New(name)
                     mat.rgbCol=[1.0, 1.0, 1.0]
                     mat.spec=0
-                    try:
-                        img=Image.Get(basename(texture))
-                    except:
-                        img=Image.Load(texture)
                     tex=Texture.New(name)
                     tex.setType('Image')
                     tex.image=img
@@ -382,7 +128,7 @@ def readDSF(path):
                     mtex=mat.getTextures()[0]
                     mtex.size=(xscale*250, zscale*250, 0)
                     mtex.zproj=Texture.Proj.NONE
-                    if t[idx][flags]:
+                    if t:
                         mtex.texco=Texture.TexCo.UV
                     else:
                         mtex.texco=Texture.TexCo.GLOB
@@ -396,12 +142,12 @@ def readDSF(path):
             mesh.mode &= ~(Mesh.Modes.TWOSIDED|Mesh.Modes.AUTOSMOOTH)
             mesh.mode |= Mesh.Modes.NOVNORMALSFLIP
             mesh.materials += [mat]
-            mesh.verts.extend(v[idx][flags])
-            mesh.faces.extend(f[idx][flags])
-            if t[idx][flags]:
+            mesh.verts.extend(v)
+            mesh.faces.extend(f)
+            if t:
                 faceno=0
                 for face in mesh.faces:
-                    face.uv=[Vector(t[idx][flags][i][0], t[idx][flags][i][1]) for i in f[idx][flags][faceno]]
+                    face.uv=[Vector(t[i][0], t[i][1]) for i in f[faceno]]
                     face.image=img
                     faceno+=1
             mesh.update()
@@ -410,6 +156,7 @@ def readDSF(path):
             ob.link(mesh)
             scene.objects.link(ob)
             ob.Layer=flags+1
+            ob.setLocation(x, y, 0)
             ob.addProperty('terrain', terrain[idx])
 
             mesh.sel=True
@@ -424,77 +171,100 @@ def readDSF(path):
                 else:
                     face.mat=1	# water
 
-    lamp=Lamp.New("Lamp", "Sun")
-    ob = Object.New("Lamp", "Sun")
-    ob.link(lamp)
-    scene.objects.link(ob)
-    lamp.type=1
-    ob.Layer=3
-    ob.setLocation(500, 500, 1000)
+
+#------------------------------------------------------------------------
+# Texture, angle and scales of a terrain definition, which is either in a
+# library or relative to the DSF's scenery pack
+def getTerrain(ters, name, path):
+    if name in libterrain:
+        return ters.get(libterrain[name])
+    local=abspath(join(dirname(path), pardir, pardir, name))
+    if exists(local):
+        return ters.get(local)
+    raise IOError(0, 'Terrain %s not found' % name, name)
+
+
+def getImage(texture):
+    if not texture in images:
+        try:
+            images[texture]=Image.Get(basename(texture))
+        except:
+            images[texture]=Image.Load(texture)
+    return images[texture]
 
 
 #------------------------------------------------------------------------
-def readTER(path):
-    texture=None
-    angle=0
-    xscale=zscale=0
-    h=file(path, 'rU')
-    if not (h.readline().strip() in ['I','A'] and
-            h.readline().strip()=='800' and
-            h.readline().strip()=='TERRAIN'):
-        raise IOError, (0, "%s is not a valid terrain file" % path, path)
-    for line in h:
-        line=line.strip()
-        c=line.split()
-        if not c: continue
-        if c[0] in ['BASE_TEX', 'BASE_TEX_NOWRAP']:
-            texture=line[len(c[0]):].strip().replace(':','/').replace('\\','/')
-            texture=abspath(join(dirname(path), texture))
-        elif c[0]=='PROJECTED':
-            xscale=1/float(c[1])
-            zscale=1/float(c[2])
-        elif c[0]=='PROJECT_ANGLE':
-            if float(c[1])==0 and float(c[2])==1 and float(c[3])==0:
-                # no idea what rotation about other axes means
-                angle=int(float(c[4]))
-    h.close()
-    return (texture, angle, xscale, zscale)
+def readLIBs(index, libpath, libterrain):
+    # packs are read in parallel, but must be processed in order
+    packs=listdir(libpath)
+    packs.sort()
+    for pack in index.scan([join(libpath,d) for d in packs]):
+        if not pack['lib']: continue
+        if not pack['valid']:
+            raise IOError
+        for (cmd, name, real) in pack['exports']:
+            if name[-4:].lower() not in ['.ter','net']: continue
+            if not name in libterrain:
+                #if len(basename(name))>25: print basename(name)[:-4], len(basename(name)[:-4])
+                libterrain[name]=normpath(real)
 
 
 #------------------------------------------------------------------------
-def readLIBs(libpath, libterrain):
-    for d in listdir(libpath):
-        if not isdir(join(libpath,d)): continue
-        for filename in listdir(join(libpath,d)):
-            if filename.lower()!='library.txt': continue
-            path=join(libpath,d)
-            h=open(join(path,filename), 'rU')
-            if not h.readline().strip()[0] in ['I','A']:
-                raise IOError
-            if not h.readline().split()[0]=='800':
-                raise IOError
-            if not h.readline().split()[0]=='LIBRARY':
-                raise IOError
-            for line in h:
-                c=line.split()
-                if not c: continue
-                if c[0] in ['EXPORT', 'EXPORT_RATIO', 'EXPORT_EXTEND']:
-                    if c[0]=='EXPORT_RATIO': c.pop(1)
-                if len(c)<3 or c[1][-4:].lower() not in ['.ter','net']: continue
-                c.pop(0)
-                name=c[0].replace(':','/').replace('\\','/')
-                if not name in libterrain:
-                    #if len(basename(name))>25: print basename(name)[:-4], len(basename(name)[:-4])
-                    c.pop(0)
-                    obj=normpath(join(path, ' '.join(c).replace(':','/').replace('\\','/')))
-                    libterrain[name]=obj
-            h.close()
-            break
+# Ask for the tiles, area and LOD to import. Returns (paths, bounds, lod,
+# parallel) for readDSFs, or None if cancelled.
+def getOptions(filename):
+    # Tile is named for its south-west corner, eg +51-003.dsf
+    tile=match(r'([+-]\d+)([+-]\d+)\.dsf$', basename(filename).lower())
+    if tile:
+        (south,west)=(int(tile.group(1)), int(tile.group(2)))
+    else:
+        (south,west)=(0,0)
+    s=Draw.Create(float(south))
+    w=Draw.Create(float(west))
+    n=Draw.Create(float(south+1))
+    e=Draw.Create(float(west+1))
+    lod=Draw.Create(0.0)
+    others=Draw.Create('')
+    parallel=Draw.Create(0)
+    block=[]
+    block.append(('Tiles:', others, 0, 399, 'Other DSF files or wildcards to import with this one, relative to its folder, eg "+5[0-2]-00[2-4].dsf"'))
+    block.append(('South:', s, -90.0, 90.0, 'Southern edge of the area to import'))
+    block.append(('West:',  w, -180.0, 180.0, 'Western edge of the area to import'))
+    block.append(('North:', n, -90.0, 90.0, 'Northern edge of the area to import'))
+    block.append(('East:',  e, -180.0, 180.0, 'Eastern edge of the area to import'))
+    block.append(('LOD (m):', lod, 0.0, 100000.0, 'Skip terrain that is only drawn beyond this distance; 0 for all'))
+    block.append(('Parallel', parallel, 'Decode several tiles at once in processes forked from Blender. Not available on Windows, and may be unsafe on Mac OS X'))
+
+    while Draw.PupBlock('Import DSF', block):
+        if s.val>=n.val or w.val>=e.val:
+            Draw.PupMenu("ERROR: North & East must be more than South & West")
+        else:
+            if (s.val,w.val,n.val,e.val)==(south,west,south+1,west+1):
+                bounds=None	# whole tile
+            else:
+                bounds=(w.val, s.val, e.val, n.val)
+            return (tilePaths(filename, others.val), bounds, lod.val or None, parallel.val)
+    return None
+
+
+# The selected tile followed by the others, which are space-separated
+# filenames or wildcards relative to its folder
+def tilePaths(filename, others):
+    paths=[abspath(filename)]
+    for pattern in others.split():
+        matches=glob(join(dirname(filename), pattern))
+        matches.sort()
+        for path in [abspath(path) for path in matches]:
+            if not path in paths:
+                paths.append(path)
+    return paths
 
 
 #------------------------------------------------------------------------
 def file_callback (filename):
-    print "Starting DSF import from " + filename
+    options=getOptions(filename)
+    if not options: return
+    print "Starting DSF import from " + ', '.join(options[0])
     Window.WaitCursor(1)
 
     if 1:#XXXtry:
@@ -505,20 +275,22 @@ def file_callback (filename):
 
         # Process libraries
         Window.DrawProgressBar(0, "Scanning libraries")
+        index=getindex(xppath)
         for d in listdir(xppath):
             if d.lower()=='custom scenery':
-                readLIBs(join(xppath,d), libterrain)
+                readLIBs(index, join(xppath,d), libterrain)
                 break
         for d in listdir(xppath):
             if d.lower()=='resources':
                 for d2 in listdir(join(xppath,d)):
                     if d2.lower()=='default scenery':
-                        readLIBs(join(xppath,d,d2), libterrain)
+                        readLIBs(index, join(xppath,d,d2), libterrain)
                         break
                 break
+        index.save()
 
         Window.DrawProgressBar(0, "Importing")
-        readDSF(filename)
+        readDSFs(*options)
     elif 0:#except IOError, e:
         Window.WaitCursor(0)
         Window.DrawProgressBar(1, "ERROR")
@@ -0,0 +1,797 @@
+#
+# Copyright (c) 2006-2013 Jonathan Harris
+#
+# This code is licensed under version 2 of the GNU General Public License.
+# http://www.gnu.org/licenses/gpl-2.0.html
+#
+# See ReadMe-XPlane2Blender.html for usage.
+#
+# DSF reading and decoding helpers used by XPlaneImportDSF. Kept separate from the
+# import script so that they don't depend on Blender.
+#
+# NumPy is used to decode the coordinate pools and to look up the patch
+# vertices in them if it is installed in Blender's Python, otherwise we fall
+# back to the array module.
+#
+
+from array import array
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5	# Python 2.4
+import marshal
+from mmap import mmap, ACCESS_READ
+from os import listdir, makedirs, name as osname, remove, rename, stat, utime
+from os.path import abspath, dirname, getmtime, getsize, isdir, join
+from struct import unpack
+from sys import byteorder, version
+
+try:
+    import numpy
+except ImportError:
+    numpy=None
+
+try:
+    import multiprocessing	# new in Python 2.6
+except ImportError:
+    multiprocessing=None
+
+
+#------------------------------------------------------------------------
+# Decode the planes of a POOL atom. data is a string or mmap holding the
+# body of the atom at offset pos. Returns a list of planes, each containing
+# n unsigned shorts. Uncompressed planes are returned as views onto data.
+def readPOOL(data, baddsf, pos=0):
+    (n,p)=unpack('<IB', data[pos:pos+5])
+    pos+=5
+    planes=[]
+    for i in range(p):
+        e=ord(data[pos])
+        pos+=1
+        if e==0 or e==1:
+            if numpy:
+                plane=numpy.frombuffer(data, '<u2', n, pos)
+            else:
+                plane=array('H', data[pos:pos+2*n])
+                if byteorder!='little': plane.byteswap()
+            pos+=2*n
+        elif e==2 or e==3:
+            (plane,pos)=readRLE(data, pos, n)
+        else:
+            raise IOError, baddsf
+        if len(plane)!=n:
+            raise IOError, baddsf
+        if e==1 or e==3:
+            plane=undelta(plane)
+        elif numpy and plane.dtype!=numpy.uint16:
+            plane=plane.astype(numpy.uint16)	# native byte order
+        planes.append(plane)
+    return planes
+
+
+# Run-length encoded plane. Returns (plane, position after the plane).
+# Each run starts with a byte - if the top bit is set the following value
+# is repeated (r&127) times, otherwise r literal values follow.
+def readRLE(data, pos, n):
+    if numpy:
+        starts=[]	# offset of the first value of each run
+        nvals=[]	# number of values stored in each run
+        reps=[]		# number of times each stored value is repeated
+        count=0
+        while count<n:
+            r=ord(data[pos])
+            if r&128:
+                starts.append(pos+1)
+                nvals.append(1)
+                reps.append(r&127)
+                count+=r&127
+                pos+=3
+            else:
+                starts.append(pos+1)
+                nvals.append(r)
+                reps.append(1)
+                count+=r
+                pos+=1+2*r
+        if not starts:
+            return (numpy.zeros(0, numpy.uint16), pos)
+        nvals=numpy.array(nvals, numpy.intp)
+        first=numpy.cumsum(nvals)-nvals		# index of first value of each run
+        offsets=numpy.repeat(numpy.array(starts, numpy.intp)-2*first, nvals) + 2*numpy.arange(nvals.sum())
+        raw=numpy.frombuffer(data, numpy.uint8, pos)
+        values=raw[offsets].astype(numpy.uint16) | (raw[offsets+1].astype(numpy.uint16)<<8)
+        plane=numpy.repeat(values, numpy.repeat(numpy.array(reps, numpy.intp), nvals))
+        return (plane[:n], pos)
+    else:
+        plane=array('H')
+        while len(plane)<n:
+            r=ord(data[pos])
+            if r&128:
+                plane.extend(array('H', data[pos+1:pos+3]) * (r&127))
+                pos+=3
+            else:
+                plane.extend(array('H', data[pos+1:pos+1+2*r]))
+                pos+=1+2*r
+        if byteorder!='little': plane.byteswap()
+        return (plane[:n], pos)
+
+
+# Undo differencing - each value is stored as the difference from the last
+def undelta(plane):
+    if numpy:
+        return numpy.cumsum(plane, dtype=numpy.uint16)	# wraps modulo 65536
+    else:
+        last=0
+        out=array('H', [0]*len(plane))
+        for j in range(len(plane)):
+            last=(last+plane[j])&65535
+            out[j]=last
+        return out
+
+
+# Apply the SCAL scale and offset to each plane and transform to one row
+# per entry, ie pool[entry][plane]. Returns an array of entries x planes with
+# NumPy, otherwise one list per entry.
+def scalePOOL(planes, scal):
+    if numpy:
+        if not planes:
+            return numpy.empty((0,0), numpy.float64)
+        pool=numpy.empty((len(planes[0]), len(planes)), numpy.float64)
+        for plane in range(len(planes)):
+            (scale,offset)=scal[plane]
+            pool[:,plane]=planes[plane]*(scale/65535)+offset
+        return pool
+    elif not planes:
+        return []
+    else:
+        cols=[]
+        for plane in range(len(planes)):
+            (scale,offset)=scal[plane]
+            scale=scale/65535
+            cols.append([d*scale+offset for d in planes[plane]])
+        return map(list, zip(*cols))
+
+
+#------------------------------------------------------------------------
+# A DSF file, memory-mapped. On opening we just build an index of the atoms
+# and read the properties, definitions and scales. Pools are only decoded
+# when they are asked for.
+class DSFfile:
+    def __init__(self, path):
+        self.path=path
+        self.baddsf=(0, "Invalid DSF file", path)
+        h=file(path, 'rb')
+        try:
+            try:
+                self.mm=mmap(h.fileno(), 0, access=ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                raise IOError, self.baddsf	# eg empty file
+        finally:
+            h.close()
+        mm=self.mm
+        if len(mm)<28 or mm[:8]!='XPLNEDSF' or unpack('<I',mm[8:12])!=(1,):
+            self.close()
+            raise IOError, self.baddsf
+
+        self.atoms=self.readAtoms(12, len(mm)-16)	# top-level atom id -> (start of body, end). Last 16 bytes are MD5
+        for c in ['DAEH','NFED','DOEG']:
+            if not c in self.atoms:
+                self.close()
+                raise IOError, self.baddsf
+
+        # Header Atom
+        self.properties=[]
+        c=self.subAtoms('DAEH').get('PORP')
+        if c:
+            c=mm[c][:-1].split('\0')
+            for i in range(0, len(c)-1, 2):
+                self.properties.append((c[i],c[i+1]))
+
+        # Definitions Atom
+        self.terrain=self.objects=self.polygons=self.networks=[]
+        defn=self.subAtoms('NFED')
+        for (c,attr) in [('TRET','terrain'), ('TJBO','objects'), ('YLOP','polygons'), ('WTEN','networks')]:
+            if c in defn:
+                setattr(self, attr, mm[defn[c]][:-1].replace('\\','/').replace(':','/').split('\0'))
+
+        # Geodata Atom - just remember where the pools are
+        self.pools=[]		# slice of each POOL atom body
+        self.scals=[]		# [(scale, offset)] per plane of each pool
+        for (c,body) in self.subAtoms('DOEG', True):
+            if c=='LOOP':
+                self.pools.append(body)
+            elif c=='LACS':
+                self.scals.append([unpack('<2f', mm[i:i+8]) for i in range(body.start, body.stop-7, 8)])
+        self.planecache={}
+        self.poolcache={}
+
+    # Returns {id: (start of body, end)} for the atoms between start and end
+    def readAtoms(self, start, end):
+        atoms={}
+        mm=self.mm
+        while start+8<=end:
+            c=mm[start:start+4]
+            (l,)=unpack('<I', mm[start+4:start+8])
+            if l<8 or start+l>end:
+                self.close()
+                raise IOError, self.baddsf
+            if not c in atoms:
+                atoms[c]=(start+8, start+l)
+            start+=l
+        return atoms
+
+    # Non-empty atoms within a top-level atom, as a dict of id -> slice of body or
+    # as a list of (id, slice of body) in file order if ordered
+    def subAtoms(self, atom, ordered=False):
+        (start,end)=self.atoms[atom]
+        atoms=[]
+        mm=self.mm
+        while start+8<=end:
+            c=mm[start:start+4]
+            (l,)=unpack('<I', mm[start+4:start+8])
+            if l<8 or start+l>end:
+                self.close()
+                raise IOError, self.baddsf
+            if l>8:
+                atoms.append((c, slice(start+8, start+l)))
+            start+=l
+        if ordered:
+            return atoms
+        d={}
+        for (c,body) in atoms:
+            if not c in d: d[c]=body
+        return d
+
+    # Raw planes of pool i, decoded on first use
+    def getPlanes(self, i):
+        if not i in self.planecache:
+            self.planecache[i]=readPOOL(self.mm, self.baddsf, self.pools[i].start)
+        return self.planecache[i]
+
+    # Pool i, scaled and as one row per entry, decoded on first use
+    def getPool(self, i):
+        if not i in self.poolcache:
+            if i>=len(self.scals):
+                raise IOError, self.baddsf
+            self.poolcache[i]=scalePOOL(self.getPlanes(i), self.scals[i])
+        return self.poolcache[i]
+
+    def close(self):
+        self.planecache={}	# drop views onto the map before closing it
+        self.poolcache={}
+        self.mm.close()
+
+
+#------------------------------------------------------------------------
+# Turn the flat arrays of a patch into the lists that Blender wants - a list
+# of [x,y,z] for each vertex, of [v1,v2,v3] for each face and of [s,t] for
+# each UV.
+def patchLists(verts, faces, uvs):
+    if numpy:
+        return (numpy.frombuffer(verts, verts.typecode).reshape(-1,3).tolist(),
+                numpy.frombuffer(faces, faces.typecode).reshape(-1,3).tolist(),
+                numpy.frombuffer(uvs, uvs.typecode).reshape(-1,2).tolist())
+    else:
+        lists=[]
+        for (a,n) in [(verts,3), (faces,3), (uvs,2)]:
+            a=a.tolist()
+            lists.append([a[i:i+n] for i in range(0, len(a), n)])
+        return tuple(lists)
+
+
+#------------------------------------------------------------------------
+# The terrain patches in a DSF's Commands atom. Reading the commands just
+# gathers the pool and point index of each vertex into integer arrays, one
+# set per (terrain definition, flags) - the vertices aren't looked up in the
+# pools until the patches are realised by arrays().
+#
+# If bounds is given as (west, south, east, north) then tris with no corner
+# inside it are dropped. If lod is given then patches whose near LOD is at or
+# beyond that distance are skipped.
+class DSFpatches:
+    def __init__(self, dsf, bounds=None, lod=None):
+        self.dsf=dsf
+        self.bounds=bounds
+        self.lod=lod
+        self.curpool=0
+        self.idx=0
+        self.flags=0	# 0=physical, 1=overlay
+        self.near=0
+        self.far=-1
+        self.skipping=False	# current patch is beyond lod
+        self.end=0	# end of the Commands atom
+        self.insides={}	# pool -> whether each entry is within bounds
+        self.pools={}	# (idx, flags) -> array('H') of the pool of each vertex
+        self.points={}	# (idx, flags) -> array('H') of the index of each vertex within its pool
+        self.faces={}	# (idx, flags) -> array('I') of vertex numbers, three per face
+
+    # Read the Commands atom. progress, if given, is called with the
+    # percentage read whenever it changes.
+    def read(self, progress=None):
+        dsf=self.dsf
+        if not 'SDMC' in dsf.atoms:
+            raise IOError, dsf.baddsf
+        (start,end)=dsf.atoms['SDMC']
+        self.end=end
+        h=dsf.mm
+        h.seek(start)
+        pscale=99.0/max(end-start, 1)
+        percent=0
+        commands=DSFpatches.commands
+        while h.tell()<end:
+            if progress:
+                now=int((h.tell()-start)*pscale)
+                if percent!=now:
+                    percent=now
+                    progress(percent)
+            c=ord(self.take(1))
+            if not c in commands:
+                raise IOError, (c, "Unrecognised command (%d)" % c, c)
+            commands[c](self, c)
+
+    # Realise the patches with the given terrain definition and flags.
+    # Returns (verts, faces, uvs) as flat arrays - verts holds
+    # (lon-west)*hscale, (lat-south)*hscale, elevation*vscale for each vertex,
+    # faces holds three vertex numbers per face and uvs holds s,t for the
+    # vertices whose pool has texture co-ordinates. See patchLists.
+    def arrays(self, key, west, south, hscale, vscale):
+        pools=self.pools[key]
+        points=self.points[key]
+        n=len(points)
+        if numpy:
+            pools=numpy.frombuffer(pools, pools.typecode)
+            points=numpy.frombuffer(points, points.typecode)
+            verts=numpy.empty((n,3), numpy.float64)
+            uvs=numpy.empty((n,2), numpy.float64)
+            hasuv=numpy.zeros(n, numpy.bool_)
+            for c in numpy.unique(pools):
+                pool=self.dsf.getPool(int(c))
+                sel=numpy.nonzero(pools==c)[0]
+                verts[sel]=pool[:,:3][points[sel]]
+                if pool.shape[1]>=7:
+                    uvs[sel]=pool[:,5:7][points[sel]]
+                    hasuv[sel]=True
+            verts-=(west, south, 0)
+            verts*=(hscale, hscale, vscale)
+            return (array('d', verts.tostring()), self.faces[key], array('d', uvs[hasuv].tostring()))
+        else:
+            verts=array('d')
+            uvs=array('d')
+            for j in range(n):
+                p=self.dsf.getPool(pools[j])[points[j]]
+                verts.extend(((p[0]-west)*hscale, (p[1]-south)*hscale, p[2]*vscale))
+                if len(p)>=7:
+                    uvs.extend((p[5],p[6]))
+            return (verts, self.faces[key], uvs)
+
+    # Arrays for the patches with the current terrain definition and flags
+    def bucket(self):
+        key=(self.idx, self.flags)
+        if not key in self.faces:
+            self.pools[key]=array('H')
+            self.points[key]=array('H')
+            self.faces[key]=array('I')
+        return (self.pools[key], self.points[key], self.faces[key])
+
+    # Read l unsigned shorts
+    def readShorts(self, l):
+        a=array('H', self.take(2*l))
+        if byteorder!='little': a.byteswap()
+        return a
+
+    # Whether each entry of pool i is within bounds
+    def inside(self, i):
+        if not i in self.insides:
+            (west, south, east, north)=self.bounds
+            pool=self.dsf.getPool(i)
+            if numpy:
+                self.insides[i]=((pool[:,0]>=west) & (pool[:,0]<=east) & (pool[:,1]>=south) & (pool[:,1]<=north)).tolist()
+            else:
+                self.insides[i]=[west<=p[0]<=east and south<=p[1]<=north for p in pool]
+        return self.insides[i]
+
+    # Add l vertices making up tris. The vertices are from the current pool,
+    # or from the pools in pools.
+    def addTris(self, points, l, pools=None):
+        if self.skipping: return
+        if pools is None:
+            pools=array('H', [self.curpool])*l
+        if self.bounds:
+            self.addCulled(pools, points)
+            return
+        (allpools, allpoints, faces)=self.bucket()
+        n=len(allpoints)
+        for i in range(n,n+l,3):
+            faces.extend((i+2,i+1,i))
+        allpools.extend(pools)
+        allpoints.extend(points)
+
+    # Add l vertices making up a fan
+    def addFan(self, points, l, pools=None):
+        if self.skipping: return
+        if pools is None:
+            pools=array('H', [self.curpool])*l
+        if self.bounds:
+            # split into separate tris so that they can be culled individually
+            tripools=array('H')
+            tripoints=array('H')
+            for i in range(1,l-1):
+                tripools.extend((pools[0],pools[i],pools[i+1]))
+                tripoints.extend((points[0],points[i],points[i+1]))
+            self.addCulled(tripools, tripoints)
+            return
+        (allpools, allpoints, faces)=self.bucket()
+        n=len(allpoints)
+        for i in range(1,l-1):
+            faces.extend((n+i+1,n+i,n))
+        allpools.extend(pools)
+        allpoints.extend(points)
+
+    # Add the tris that have at least one corner within bounds
+    def addCulled(self, pools, points):
+        (allpools, allpoints, faces)=self.bucket()
+        n=len(allpoints)
+        for i in range(0, len(points)-2, 3):
+            if (self.inside(pools[i])[points[i]] or
+                self.inside(pools[i+1])[points[i+1]] or
+                self.inside(pools[i+2])[points[i+2]]):
+                faces.extend((n+2,n+1,n))
+                allpools.extend(pools[i:i+3])
+                allpoints.extend(points[i:i+3])
+                n+=3
+
+    # Read l bytes of the Commands atom. A short read means a truncated or
+    # corrupt file, so raise the IOError that the importers report.
+    def take(self, l):
+        data=self.dsf.mm.read(l)
+        if len(data)<l or self.dsf.mm.tell()>self.end:
+            raise IOError, self.dsf.baddsf
+        return data
+
+    def skip(self, l):
+        self.take(l)
+
+    def doPoolSelect(self, c):
+        (self.curpool,)=unpack('<H', self.take(2))
+
+    def doDefinition8(self, c):
+        self.idx=ord(self.take(1))
+
+    def doDefinition16(self, c):
+        (self.idx,)=unpack('<H', self.take(2))
+
+    def doDefinition32(self, c):
+        (self.idx,)=unpack('<I', self.take(4))
+
+    def doNotImplemented(self, c):
+        self.skip({2:4, 6:1, 7:2, 8:4, 10:4, 13:6}[c])
+
+    def doChain(self, c):	# Network Chain
+        l=ord(self.take(1))
+        self.skip(l*{9:2, 11:4}[c])	# not implemented
+
+    def doPolygon(self, c):
+        (param,l)=unpack('<HB', self.take(3))
+        self.skip(l*2)	# not implemented
+
+    def doNestedPolygon(self, c):
+        (param,n)=unpack('<HB', self.take(3))
+        for i in range(n):
+            self.skip(ord(self.take(1))*2)	# not implemented
+
+    def doNestedPolygonRange(self, c):	# DSF2Text uses this one
+        (param,n)=unpack('<HB', self.take(3))
+        self.skip((n+1)*2)	# not implemented
+
+    # Skip patches that are only drawn beyond lod
+    def setLOD(self):
+        self.skipping=self.lod is not None and self.near>=self.lod
+
+    def doPatch(self, c):
+        self.setLOD()
+
+    def doPatchFlags(self, c):
+        self.flags=ord(self.take(1))-1
+        self.setLOD()
+
+    def doPatchLOD(self, c):
+        (self.flags,self.near,self.far)=unpack('<Bff', self.take(9))
+        self.flags-=1
+        self.setLOD()
+
+    def doTriangle(self, c):
+        l=ord(self.take(1))
+        self.addTris(self.readShorts(l), l)
+
+    def doTriangleCross(self, c):
+        l=ord(self.take(1))
+        data=self.readShorts(2*l)
+        self.addTris(data[1::2], l, data[0::2])
+
+    def doTriangleRange(self, c):
+        (first,last)=unpack('<HH', self.take(4))
+        self.addTris(array('H', range(first,last)), max(last-first,0))
+
+    def doFan(self, c):
+        l=ord(self.take(1))
+        self.addFan(self.readShorts(l), l)
+
+    def doFanCross(self, c):
+        l=ord(self.take(1))
+        data=self.readShorts(2*l)
+        self.addFan(data[1::2], l, data[0::2])
+
+    def doFanRange(self, c):
+        (first,last)=unpack('<HH', self.take(4))
+        self.addFan(array('H', range(first,last)), max(last-first,0))
+
+    def doComment8(self, c):
+        self.skip(ord(self.take(1)))
+
+    def doComment16(self, c):
+        (l,)=unpack('<H', self.take(2))
+        self.skip(l)
+
+    def doComment32(self, c):
+        (l,)=unpack('<I', self.take(4))
+        self.skip(l)
+
+    # Patch Triangle Strips (26-28) aren't used by DSF2Text
+    commands={
+        1:  doPoolSelect,		# Coordinate Pool Select
+        2:  doNotImplemented,		# Junction Offset Select
+        3:  doDefinition8,		# Set Definition
+        4:  doDefinition16,
+        5:  doDefinition32,
+        6:  doNotImplemented,		# Set Road Subtype
+        7:  doNotImplemented,		# Object
+        8:  doNotImplemented,		# Object Range
+        9:  doChain,			# Network Chain
+        10: doNotImplemented,		# Network Chain Range
+        11: doChain,			# Network Chain
+        12: doPolygon,			# Polygon
+        13: doNotImplemented,		# Polygon Range (DSF2Text uses this one)
+        14: doNestedPolygon,		# Nested Polygon
+        15: doNestedPolygonRange,	# Nested Polygon Range
+        16: doPatch,			# Terrain Patch
+        17: doPatchFlags,		# Terrain Patch w/ flags
+        18: doPatchLOD,			# Terrain Patch w/ flags & LOD
+        23: doTriangle,			# Patch Triangle
+        24: doTriangleCross,		# Patch Triangle - cross-pool
+        25: doTriangleRange,		# Patch Triangle Range
+        29: doFan,			# Patch Triangle Fan
+        30: doFanCross,			# Patch Triangle Fan - cross-pool
+        31: doFanRange,			# Patch Triangle Fan Range
+        32: doComment8,			# Comment
+        33: doComment16,
+        34: doComment32,
+        }
+
+
+#------------------------------------------------------------------------
+# Decode the terrain patches of a DSF tile. Returns (west, south, terrain,
+# [(idx, flags, verts, faces, uvs)]) where terrain is the terrain definitions
+# and each patch's arrays are as returned by DSFpatches.arrays, relative to
+# the tile's south-west corner.
+def decodeTile(path, bounds=None, lod=None, hscale=1, vscale=1, progress=None):
+    dsf=DSFfile(path)
+    try:
+        overlay=0
+        for (k,v) in dsf.properties:
+            if k=='sim/overlay': overlay=int(v)
+            elif k=='sim/south': south=int(v)
+            elif k=='sim/west': west=int(v)
+        if overlay:
+            # Overlay DSF - bail early
+            raise IOError, (0, "This is an overlay DSF", path)
+
+        # Geodata Atom - pools are decoded as they're referenced by the patches
+        if len(dsf.scals)!=len(dsf.pools):
+            raise IOError, (0, "Invalid DSF file %s - %d scales for %d point pools" % (path, len(dsf.scals), len(dsf.pools)), path)
+
+        # Commands Atom
+        patches=DSFpatches(dsf, bounds, lod)
+        patches.read(progress)
+        keys=[k for k in patches.faces if patches.faces[k]]
+        keys.sort()
+        arrays=[k+patches.arrays(k, west, south, hscale, vscale) for k in keys]
+    finally:
+        dsf.close()
+    return (west, south, dsf.terrain, arrays)
+
+# A decoded tile with its arrays as strings, which are quicker to pickle or
+# marshal than the arrays themselves
+def packTile(tile):
+    (west, south, terrain, patches)=tile
+    return (west, south, terrain, [(idx, flags, verts.tostring(), faces.tostring(), uvs.tostring())
+                                   for (idx, flags, verts, faces, uvs) in patches])
+
+def unpackTile(tile):
+    (west, south, terrain, patches)=tile
+    return (west, south, terrain, [(idx, flags, array('d', verts), array('I', faces), array('d', uvs))
+                                   for (idx, flags, verts, faces, uvs) in patches])
+
+def decodeTask(args):
+    return packTile(decodeTile(*args))
+
+# Decode a list of tiles, each given as the arguments to decodeTile. If
+# parallel is set they are decoded by a pool of processes if we can. The
+# tiles are independent so this scales with the number of cores. Worker
+# processes are forked from Blender, which isn't safe everywhere, so this is
+# off by default. Tiles are decoded one at a time on Windows, on Pythons
+# before 2.6 and if the pool can't be created.
+def decodeTiles(tiles, processes=None, parallel=False):
+    pool=None
+    if parallel and len(tiles)>1 and multiprocessing and osname=='posix':
+        try:
+            if (processes or multiprocessing.cpu_count())>1:
+                pool=multiprocessing.Pool(processes)
+        except:
+            pool=None
+    if pool:
+        try:
+            return map(unpackTile, pool.map(decodeTask, tiles))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        return [decodeTile(*args) for args in tiles]
+
+
+#------------------------------------------------------------------------
+# On-disk cache of decoded DSF tiles, so that importing the same tile again
+# doesn't decode it again. Each entry is a marshal file named for a hash of
+# its key, which covers the DSF's path, size and modification time and the
+# import options. It holds the tile as returned by decodeTile. Entries are touched when used, and once the cache grows beyond
+# size bytes the least recently used are removed.
+DSFCACHE_VERSION=2
+DSFCACHE_SIZE=256*1024*1024
+DSFCACHE_SUFFIX='.dsfcache'
+
+class DSFcache:
+    def __init__(self, folder, size=DSFCACHE_SIZE):
+        self.folder=folder
+        self.size=size
+
+    def key(self, path, *options):
+        st=stat(path)
+        return (DSFCACHE_VERSION, version, byteorder, abspath(path), st.st_size, st.st_mtime)+options
+
+    def filename(self, key):
+        return join(self.folder, md5(repr(key)).hexdigest()+DSFCACHE_SUFFIX)
+
+    # Returns the tile as passed to put, or None if it isn't cached
+    def get(self, key):
+        filename=self.filename(key)
+        try:
+            h=file(filename, 'rb')
+            try:
+                (k, tile)=marshal.load(h)
+            finally:
+                h.close()
+        except:	# missing, unreadable or from another version of Python
+            return None
+        if k!=key:
+            return None
+        try:
+            utime(filename, None)
+        except EnvironmentError:
+            pass
+        return unpackTile(tile)
+
+    def put(self, key, tile):
+        filename=self.filename(key)
+        tmp=filename+'.tmp'
+        try:
+            if not isdir(self.folder):
+                makedirs(self.folder)
+            h=file(tmp, 'wb')
+            try:
+                marshal.dump((key, packTile(tile)), h)
+            finally:
+                h.close()
+            try:
+                remove(filename)	# rename won't replace on Windows
+            except EnvironmentError:
+                pass
+            rename(tmp, filename)
+        except EnvironmentError:
+            return	# eg read-only - just don't cache
+        self.evict()
+
+    # Remove the least recently used entries until the cache fits in size
+    def evict(self):
+        try:
+            entries=[]
+            for f in listdir(self.folder):
+                if f.endswith(DSFCACHE_SUFFIX):
+                    f=join(self.folder, f)
+                    entries.append((getmtime(f), getsize(f), f))
+            entries.sort()
+            total=sum([size for (mtime, size, f) in entries])
+            while len(entries)>1 and total>self.size:	# always keep the newest
+                (mtime, size, f)=entries.pop(0)
+                remove(f)
+                total-=size
+        except EnvironmentError:
+            pass
+
+
+#------------------------------------------------------------------------
+# Returns (texture, angle, xscale, zscale) from a terrain definition (.ter)
+def readTER(path):
+    texture=None
+    angle=0
+    xscale=zscale=0
+    h=file(path, 'rU')
+    if not (h.readline().strip() in ['I','A'] and
+            h.readline().strip()=='800' and
+            h.readline().strip()=='TERRAIN'):
+        raise IOError, (0, "%s is not a valid terrain file" % path, path)
+    for line in h:
+        line=line.strip()
+        c=line.split()
+        if not c: continue
+        if c[0] in ['BASE_TEX', 'BASE_TEX_NOWRAP']:
+            texture=line[len(c[0]):].strip().replace(':','/').replace('\\','/')
+            texture=abspath(join(dirname(path), texture))
+        elif c[0]=='PROJECTED':
+            xscale=1/float(c[1])
+            zscale=1/float(c[2])
+        elif c[0]=='PROJECT_ANGLE':
+            if float(c[1])==0 and float(c[2])==1 and float(c[3])==0:
+                # no idea what rotation about other axes means
+                angle=int(float(c[4]))
+    h.close()
+    return (texture, angle, xscale, zscale)
+
+
+# Terrain definitions, parsed on first use and remembered between imports in
+# cachefile if given. A definition is re-read if its size or modification
+# time has changed.
+TERCACHE_VERSION=1
+
+class TERcache:
+    def __init__(self, cachefile=None):
+        self.cachefile=cachefile
+        self.ters={}	# path -> ((size, mtime), (texture, angle, xscale, zscale))
+        self.dirty=False
+        if cachefile:
+            try:
+                h=file(cachefile, 'rb')
+                try:
+                    (v, ters)=marshal.load(h)
+                finally:
+                    h.close()
+                if v==(TERCACHE_VERSION, version):
+                    self.ters=ters
+            except:	# missing, unreadable or from another version of Python
+                pass
+
+    def get(self, path):
+        st=stat(path)
+        stamp=(st.st_size, st.st_mtime)
+        if path in self.ters and self.ters[path][0]==stamp:
+            return self.ters[path][1]
+        ter=readTER(path)
+        self.ters[path]=(stamp, ter)
+        self.dirty=True
+        return ter
+
+    # Write the cache file, if anything has changed
+    def save(self):
+        if not self.dirty or not self.cachefile: return
+        tmp=self.cachefile+'.tmp'
+        try:
+            h=file(tmp, 'wb')
+            try:
+                marshal.dump(((TERCACHE_VERSION, version), self.ters), h)
+            finally:
+                h.close()
+            try:
+                remove(self.cachefile)	# rename won't replace on Windows
+            except EnvironmentError:
+                pass
+            rename(tmp, self.cachefile)
+            self.dirty=False
+        except EnvironmentError:
+            pass	# eg read-only - just don't cache
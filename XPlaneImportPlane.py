@@ -27,7 +27,7 @@ import sys
 import Blender
 from Blender import Object, NMesh, Lamp, Image, Material, Window, Mathutils
 from Blender.Mathutils import Vector, Matrix, RotationMatrix, ScaleMatrix, TranslationMatrix, Quaternion
-from struct import unpack
+from struct import unpack, Struct
 from math import hypot, pi, sin, cos, atan, radians
 from os import listdir
 from os.path import basename, dirname, join, splitext
@@ -3802,7 +3802,8 @@ class ACF:
         if dmp:
             dmp.write("%6x:\tHEADER_version:\t%s\n" % (1,self.HEADER_version))
 
-        self.parse(acffile, dmp, defs, fmt, prefix, prg)
+        if dmp or not self.unpack(acffile, defs, fmt, prg):
+            self.parse(acffile, dmp, defs, fmt, prefix, prg)
         if dmp: dmp.close()
         acffile.close()
 
@@ -3884,6 +3885,133 @@ class ACF:
         self.OVERFLOW_custom_st_coords=0
 
 
+    #------------------------------------------------------------------------
+    # Fast path - read the rest of the file in one go and decode it with a
+    # single Struct compiled from the DEFfmt table. Returns False if the file
+    # is too short, in which case the caller should fall back to parse().
+
+    layouts={}	# (HEADER_version, byte order) -> (Struct, fields)
+
+    def unpack(self, acffile, defs, fmt, prg):
+        key=(self.HEADER_version, fmt)
+        if not key in ACF.layouts:
+            (f, fields)=self.compile(acffile, defs)
+            ACF.layouts[key]=(Struct(fmt+''.join(f)), fields)
+        (layout, fields)=ACF.layouts[key]
+
+        off=acffile.tell()
+        c=acffile.read(layout.size)
+        if len(c)<layout.size:
+            acffile.seek(off)
+            return False
+        if prg:
+            Window.DrawProgressBar(0, "Reading data ...")
+        self.unpackfields(fields, layout.unpack_from(c), 0, self)
+        return True
+
+    # Flatten a DEFfmt table into a list of struct format codes, and a list
+    # of (var, type, outer dimensions, number, size, sub-fields) that says how
+    # to put the unpacked values back together.
+    def compile(self, acffile, defs):
+        f=[]
+        fields=[]
+        for i in range(0,len(defs),2):
+            t=defs[i]	# Data type
+            k=defs[i+1].split("[")
+            var=k.pop(0).strip()
+            for j in range(len(k)):
+                k[j]=int(k[j][:-1])
+            size=4	# ints and floats
+            if t==DEFfmt.xchr:
+                if len(k)>0:
+                    size=k.pop()
+                else:
+                    size=1
+            if len(k)>0:
+                number=k.pop()
+            else:
+                number=1
+            count=number
+            for o in k:
+                count*=o
+
+            sub=None
+            if t==DEFfmt.xstruct:
+                (sf, sub)=self.compile(acffile, getattr(DEFfmt, "%s%s" % (var, self.HEADER_version)))
+                f.extend(sf*count)
+            elif t==DEFfmt.xchr:
+                f.append(("%ds" % size)*count)
+            elif t==DEFfmt.xint:
+                f.append("%di" % count)
+            elif t==DEFfmt.xflt:
+                f.append("%df" % count)
+            else:
+                acffile.close()
+                raise ParseError("Can't parse file")
+            fields.append((var, t, k, number, size, sub))
+        return (f, fields)
+
+    # Assign the unpacked values vals, starting at pos, to thing's attributes
+    def unpackfields(self, fields, vals, pos, thing):
+        for (var, t, k, number, size, sub) in fields:
+            if (t==DEFfmt.xint or t==DEFfmt.xflt) and k:
+                # Bulk slice numeric arrays into rows, then nest
+                n=k[0]
+                if len(k)>1: n*=k[1]
+                if number==1:
+                    v=list(vals[pos:pos+n])
+                else:
+                    v=map(list, zip(*[iter(vals[pos:pos+n*number])]*number))
+                pos+=n*number
+                if len(k)>1:
+                    v=map(list, zip(*[iter(v)]*k[1]))
+            elif len(k)==0:
+                (v,pos)=self.unpackdata(vals, pos, number, size, t, sub)
+            elif len(k)==1:
+                v=[]
+                for o in range(k[0]):
+                    (x,pos)=self.unpackdata(vals, pos, number, size, t, sub)
+                    v.append(x)
+            else:
+                v=[]
+                for o in range(k[0]):
+                    vo=[]
+                    for p in range(k[1]):
+                        (x,pos)=self.unpackdata(vals, pos, number, size, t, sub)
+                        vo.append(x)
+                    v.append(vo)
+            setattr(thing, var, v)
+        return pos
+
+    # Equivalent of data() for already unpacked values. Returns (value, pos)
+    def unpackdata(self, vals, pos, number, size, t, sub):
+        if t==DEFfmt.xint or t==DEFfmt.xflt:
+            if number==1:
+                return (vals[pos], pos+1)
+            return (list(vals[pos:pos+number]), pos+number)
+        v=[]
+        for i in range(number):
+            if t==DEFfmt.xstruct:
+                x=ACF.XStruct()
+                pos=self.unpackfields(sub, vals, pos, x)
+            else:
+                c=vals[pos]
+                pos+=1
+                if size==1:
+                    if "0123456789".find(c)!=-1:
+                        x=int(c)
+                    else:
+                        x=0
+                elif c.find("\0")!=-1:
+                    x=c[:c.index("\0")]	# trim nulls
+                else:
+                    x=c
+            if number==1:
+                return (x, pos)
+            v.append(x)
+        return (v, pos)
+
+
     #------------------------------------------------------------------------
     def data(self, acffile, dmp, number, size, t, fmt, var):
         v=[]
@@ -8,12 +8,15 @@
 #
 
 import sys
+import re
 import Blender
 from Blender import Armature, Object, Mesh, NMesh, Lamp, Image, Material, Texture, Draw, Window
 from Blender.Mathutils import Matrix, RotationMatrix, TranslationMatrix, Vector
 from XPlaneUtils import Vertex, UV, Face, PanelRegionHandler, getDatarefs, make_short_name
 
-from math import radians
+from array import array
+from math import floor, radians
+from operator import neg
 from os import listdir
 from os.path import abspath, basename, curdir, dirname, join, normpath, sep, splitdrive, splitext
 #import time
@@ -58,12 +61,60 @@ class Mat:
             self.blenderMat.spec=self.s
         return self.blenderMat
 
+#------------------------------------------------------------------------
+# Index of faces for finding back-to-back duplicates. Each vertex of each
+# face is filed under its grid cell, and candidates are confirmed with
+# Vertex.equals. Cells are ten times the Vertex merge window, so a lookup
+# only needs to look in a neighbouring cell when a co-ordinate is within
+# the window of a cell boundary.
+class FaceIndex:
+    def __init__(self):
+        self.cells={}		# quantised vertex -> [(face, vertex number)]
+        self.tol=Vertex.LIMIT
+        self.size=self.tol*10
+
+    def add(self, face):
+        size=self.size
+        for i in range(len(face.v)):
+            v=face.v[i]
+            k=(int(floor(v.x/size)), int(floor(v.y/size)), int(floor(v.z/size)))
+            if k in self.cells:
+                self.cells[k].append((face,i))
+            else:
+                self.cells[k]=[(face,i)]
+
+    # Is there a face with the same vertices as face but in reverse order?
+    # Faces that differ only in which vertex they start at match.
+    def findback(self, face):
+        v0=face.v[0]
+        (tol,size)=(self.tol,self.size)
+        keys=[()]
+        for x in (v0.x, v0.y, v0.z):
+            lo=int(floor((x-tol)/size))
+            hi=int(floor((x+tol)/size))
+            if lo==hi:
+                keys=[k+(lo,) for k in keys]
+            else:
+                keys=[k+(c,) for c in range(lo,hi+1) for k in keys]
+        n=len(face.v)
+        for k in keys:
+            if not k in self.cells: continue
+            for (other,i) in self.cells[k]:
+                if len(other.v)!=n or not v0.equals(other.v[i]): continue
+                for j in range(1,n):
+                    if not face.v[j].equals(other.v[(i-j)%n]): break
+                else:
+                    return True
+        return False
+
+
 class MyMesh:
     # Flags
     LAYERMASK=7
 
     def __init__(self, faces=[], surface=None, deck=None, layers=1, anim=None, mat=None):
         self.faces=[]
+        self.index=FaceIndex()	# for isduplicate
         self.surface=surface	# Hard surface type or None
         self.deck=deck		# Hard surface deck type or None
         self.layers=layers	# LOD
@@ -73,30 +124,17 @@ class MyMesh:
 
     def addFaces(self, faces):
         self.faces.extend(faces)
+        for face in faces:
+            self.index.add(face)
 
     #------------------------------------------------------------------------
     # are faces back-to-back duplicates?
     def isduplicate(self,faces):
         # print "isdupe", len(self.faces), len(faces)
-        if len(faces[0].v)==3:	# assumes all new faces have same #vertices
-            for face1 in faces:
-                for face2 in self.faces:
-                    if (len(face2.v)==3 and
-                        face1.v[0].equals(face2.v[2]) and
-                        face1.v[1].equals(face2.v[1]) and
-                        face1.v[2].equals(face2.v[0])):
-                        #print "dupe", face1, face2
-                        return True
-        elif len(faces[0].v)==4:
-            for face1 in faces:
-                for face2 in self.faces:
-                    if (len(face2.v)==4 and
-                        face1.v[0].equals(face2.v[3]) and
-                        face1.v[1].equals(face2.v[2]) and
-                        face1.v[2].equals(face2.v[1]) and
-                        face1.v[3].equals(face2.v[0])):
-                        #print "dupe", face1, face2
-                        return True
+        for face in faces:
+            if self.index.findback(face):
+                #print "dupe", face
+                return True
         return False
 
     #------------------------------------------------------------------------
@@ -213,6 +251,39 @@ class MyMesh:
         return ob
 
 
+#------------------------------------------------------------------------
+# v8 vertex tables, kept as flat arrays of doubles rather than as objects.
+# VT rows are x,y,z, nx,ny,nz, s,t. VLINE and VLIGHT rows are x,y,z, r,g,b.
+# Co-ordinates are already rotated to Blender format and rounded.
+# Rows are turned into objects on first use and then shared, as they were
+# when the tables were lists.
+class VTable:
+    def __init__(self, width):
+        self.width=width
+        self.data=array('d')
+        self.rows={}
+
+    def __len__(self):
+        return len(self.data)/self.width
+
+    def extend(self, row):
+        self.data.extend(row)
+
+    # returns (v,uv,n) for VT or (v,c) for VLINE and VLIGHT
+    def __getitem__(self, i):
+        if i in self.rows: return self.rows[i]
+        d=self.data
+        j=i*self.width
+        if j<0 or j>=len(d): raise IndexError
+        if self.width==8:
+            row=(Vertex(d[j],d[j+1],d[j+2]), UV(d[j+6],d[j+7]),
+                 Vertex(d[j+3],d[j+4],d[j+5]))
+        else:
+            row=(Vertex(d[j],d[j+1],d[j+2]), [d[j+3],d[j+4],d[j+5]])
+        self.rows[i]=row
+        return row
+
+
 #------------------------------------------------------------------------
 #-- OBJimport --
 #------------------------------------------------------------------------
@@ -258,6 +329,8 @@ class OBJimport:
         self.linesemi=0.025
         self.file=None		# file handle
         self.filelen=0		# for progress reports
+        self.lines=None		# rest of file, if slurped by readTables
+        self.lineidx=0		# next line in self.lines
         self.line=None		# current input line
         self.lineno=0		# for error reporting
         self.progress=-1
@@ -275,10 +348,10 @@ class OBJimport:
         self.fusecount=0
 
         # v8 structures
-        self.vt=[]
-        self.vline=[]
-        self.vlight=[]
-        self.idx=[]
+        self.vt=VTable(8)
+        self.vline=VTable(6)
+        self.vlight=VTable(6)
+        self.idx=array('i')
 
         # attributes
         self.hard=False
@@ -391,9 +464,17 @@ class OBJimport:
     #------------------------------------------------------------------------
     def getCR(self, optional=False):
         while True:
-            line=self.file.readline()
+            if self.lines is None:
+                line=self.file.readline()
+            elif self.lineidx<len(self.lines):
+                line=self.lines[self.lineidx]
+                self.lineidx+=1
+            else:
+                line=''
             self.lineno+=1
-            if not line:
+            if line is None:
+                continue	# already read by readTables
+            elif not line:
                 if optional:
                     return False
                 else:
@@ -503,16 +584,122 @@ class OBJimport:
         print 'Warn:\tTexture file "%s" not found' % base
         self.log.append('Texture file "%s" not found' % base)
 
+    #------------------------------------------------------------------------
+    # v8 fast path. Slurp the rest of the file and parse the VT, VLINE,
+    # VLIGHT, IDX and IDX10 records in bulk. Parsed lines are replaced with
+    # None so that getCR skips them. Only the header statements listed in
+    # OBJimport.preamble may come before the tables. Stops at the first
+    # other command or at the first record that isn't well-formed, leaving
+    # it and everything after it to readObjects, which will parse or
+    # complain about it in the usual way.
+    def readTables(self):
+        self.lines=self.file.readlines()
+        self.lineidx=0
+        tables={'VT':[], 'VLINE':[], 'VLIGHT':[], 'IDX':[]}
+        sizes={'VT':9, 'VLINE':7, 'VLIGHT':7, 'IDX10':11, 'IDX':2}
+        done=[]		# lines parsed
+        text=[]		# co-ordinate lines parsed
+        for i in range(len(self.lines)):
+            line=self.lines[i]
+            if '#' in line or '/' in line:
+                c=line.split('#')[0].split('//')[0].split()
+            else:
+                c=line.split()
+            if not c: continue
+            t=c[0]
+            if not t in sizes:
+                if done or not (t in OBJimport.preamble or t.startswith('GLOBAL_')):
+                    break
+                continue
+            if len(c)!=sizes[t]: break
+            if t=='IDX10':
+                tables['IDX'].extend(c[1:])
+            else:
+                tables[t].extend(c[1:])
+                if t!='IDX': text.append(line)
+            done.append(i)
+        if not done: return
+
+        exact=not re.search(r'\.\d{5}|\d[eE]', ''.join(text))	# nothing to round
+        try:
+            vt=self.parseTable(tables['VT'], 8, exact)
+            vline=self.parseTable(tables['VLINE'], 6, exact)
+            vlight=self.parseTable(tables['VLIGHT'], 6, exact)
+            idx=array('i', map(int, tables['IDX']))
+        except ValueError:
+            return	# let readObjects report it
+        self.vt.extend(vt)
+        self.vline.extend(vline)
+        self.vlight.extend(vlight)
+        self.idx.extend(idx)
+        for i in done:
+            self.lines[i]=None
+
+    # Convert table records to floats and rotate co-ordinates to Blender format
+    def parseTable(self, tokens, width, exact):
+        d=array('d', map(float, tokens))
+        cols=[d[i::width] for i in range(width)]
+        for i in range(0, width==8 and 6 or 3, 3):
+            # getVertex
+            (x,y,z)=(cols[i], array('d', map(neg, cols[i+2])), cols[i+1])
+            if not exact:
+                (x,y,z)=[array('d', [round(a,Vertex.ROUND) for a in col]) for col in (x,y,z)]
+            (cols[i],cols[i+1],cols[i+2])=(x,y,z)
+        for i in range(width):
+            d[i::width]=cols[i]
+        return d
+
+    #------------------------------------------------------------------------
+    # v8 table records, which make up most of a v8 file. readObjects
+    # dispatches these through records; the other commands stay in its elif
+    # chain since they are under 1% of the lines in a v8 file, several share
+    # a handler or are v6 numeric tokens, and ####_ is matched on a prefix.
+    def readVT(self):
+        v=self.getVertex()
+        n=self.getVertex()	# normal
+        uv=self.getUV()
+        self.vt.extend([v.x,v.y,v.z, n.x,n.y,n.z, uv.s,uv.t])
+
+    def readVLINE(self):
+        v=self.getVertex()
+        c=self.getCol()
+        self.vline.extend([v.x,v.y,v.z]+c)
+
+    def readVLIGHT(self):
+        v=self.getVertex()
+        c=self.getCol()
+        self.vlight.extend([v.x,v.y,v.z]+c)
+
+    def readIDX10(self):
+        self.idx.extend([self.getInt() for i in range(10)])
+
+    def readIDX(self):
+        self.idx.append(self.getInt())
+
+    records={'VT':readVT, 'VLINE':readVLINE, 'VLIGHT':readVLIGHT,
+             'IDX10':readIDX10, 'IDX':readIDX}
+
+    # v8 header statements that readTables can skip over
+    preamble=['POINT_COUNTS', 'TEXTURE_LIT', 'TEXTURE_NORMAL', 'EXPORT']
+
     #------------------------------------------------------------------------
     def readObjects (self, scene):
 
+        if self.fileformat==8:
+            self.readTables()
+
         while True:
             if not self.subroutine:
-                pos=self.file.tell()
-                progress=pos*50/self.filelen
+                if self.lines is None:
+                    pos=self.file.tell()
+                    end=self.filelen
+                else:
+                    pos=self.lineidx
+                    end=max(len(self.lines),1)
+                progress=pos*50/end
                 # only update progress bar if need to
                 if self.progress!=progress:
-                    Window.DrawProgressBar(float(pos)*0.5/self.filelen,
+                    Window.DrawProgressBar(float(pos)*0.5/end,
                                            "Importing %s%% ..." % progress)
                     self.progress=progress
 
@@ -529,6 +716,9 @@ class OBJimport:
             if t in ['end', 99]:
                 break
 
+            elif t in OBJimport.records:
+                OBJimport.records[t](self)
+
             # v8
 
             elif t=='COCKPIT_REGION':
@@ -544,28 +734,6 @@ class OBJimport:
                 height=self.getInt()-xoff
                 self.regions.append(h.addRegion(xoff, yoff, width, height))
 
-            elif t=='VT':
-                v=self.getVertex()
-                n=self.getVertex()	# normal
-                uv=self.getUV()
-                self.vt.append((v,uv,n))
-
-            elif t=='VLINE':
-                v=self.getVertex()
-                c=self.getCol()
-                self.vline.append((v,c))
-
-            elif t=='VLIGHT':
-                v=self.getVertex()
-                c=self.getCol()
-                self.vlight.append((v,c))
-
-            elif t=='IDX10':
-                self.idx.extend([self.getInt() for i in range(10)])
-
-            elif t=='IDX':
-                self.idx.append(self.getInt())
-
             elif t=='LIGHTS':
                 self.addpendingbone()
                 a=self.getInt()
@@ -1542,28 +1710,28 @@ class OBJimport:
 
         facelookup={}        # detect back-to-back duplicate faces
         faces=[]
+        vt=self.vt.data
+        idx=self.idx
+        limit=Vertex.LIMIT
         for i in range(a,a+b,3):
             face=Face()
             # points are reversed
-            (vj,uvj,n2)=self.vt[self.idx[i+2]]
-            v=[vj.totuple()]
-            face.addVertex(vj)
-            face.addUV(uvj)
-            (vj,uvj,n1)=self.vt[self.idx[i+1]]
-            v.append(vj.totuple())
-            face.addVertex(vj)
-            face.addUV(uvj)
-            (vj,uvj,n0)=self.vt[self.idx[i]]
-            v.append(vj.totuple())
-            face.addVertex(vj)
-            face.addUV(uvj)
+            v=[]
+            for k in (idx[i+2], idx[i+1], idx[i]):
+                (vj,uvj,n)=self.vt[k]
+                v.append(vj.totuple())
+                face.addVertex(vj)
+                face.addUV(uvj)
 
             face.flags=flags
             face.region=region
-            if not self.flat and n0.equals(n1) and n1.equals(n2):
-                # Should check that vertex normals equal plane
-                # normal, but unlikely that won't be true.
-                face.flags|=Face.FLAT
+            if not self.flat:
+                (n2,n1,n0)=[vt[j+3:j+6] for j in (idx[i+2]*8, idx[i+1]*8, idx[i]*8)]
+                if (abs(n0[0]-n1[0])<=limit and abs(n0[1]-n1[1])<=limit and abs(n0[2]-n1[2])<=limit and
+                    abs(n1[0]-n2[0])<=limit and abs(n1[1]-n2[1])<=limit and abs(n1[2]-n2[2])<=limit):
+                    # Should check that vertex normals equal plane
+                    # normal, but unlikely that won't be true.
+                    face.flags|=Face.FLAT
 
             # Duplicate may be rotated
             if tuple(v) in facelookup or (v[1],v[2],v[0]) in facelookup or (v[2],v[0],v[1]) in facelookup:
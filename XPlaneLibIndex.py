@@ -0,0 +1,380 @@
+#
+# Copyright (c) 2013 Jonathan Harris
+#
+# This code is licensed under version 2 of the GNU General Public License.
+# http://www.gnu.org/licenses/gpl-2.0.html
+#
+# See ReadMe-XPlane2Blender.html for usage.
+#
+# Index of the scenery library, shared by XPlaneLib, XPlaneImportDSF and
+# XPlaneRoads. Doesn't depend on Blender.
+#
+# The contents of each scenery pack are remembered in a cache file in the
+# X-Plane folder, together with the modification times of the pack folder
+# and of its library.txt. On later runs a pack is only re-read if one of
+# those has changed, so a warm lookup just stats the pack folders. Packs
+# that do need to be read are read by a pool of threads, since on a network
+# share most of the time is spent waiting on the file system.
+#
+# Run this file from the command line to benchmark it.
+#
+
+import cPickle
+import sys
+from os import listdir, remove, rename, stat, walk
+from os.path import dirname, isdir, normcase
+from Queue import Queue, Empty
+from threading import Thread
+
+CACHENAME='XPlane2Blender.libcache'
+CACHEVERSION=2
+THREADS=8	# max number of packs to read at once
+
+# Folders in the X-Plane folder that hold scenery packs, in priority order
+SCENERY=['Custom Scenery', 'Global Scenery', 'Resources/default scenery']
+
+
+# Key under which a pack or X-Plane folder is remembered. Callers build
+# paths with either os.path.join or '/', and Windows paths are not case
+# sensitive, so both are folded.
+def packkey(path):
+    return normcase(path).replace('\\','/')
+
+# Returns the real case of name in folder, or None if not found
+def findname(folder, name):
+    try:
+        for f in listdir(folder):
+            if f.lower()==name.lower():
+                return f
+    except OSError:
+        pass
+    return None
+
+def getmtime(path):
+    try:
+        return stat(path).st_mtime
+    except OSError:
+        return None
+
+
+# Returns ({folder: mtime}, [file paths relative to pack]) for all the
+# folders and files in a pack
+def walkfiles(pack):
+    dirs={}
+    files=[]
+    for root, subdirs, names in walk(pack):
+        dirs[root]=getmtime(root)
+        for f in names:
+            if root==pack:
+                files.append(f)
+            else:
+                files.append(root[len(pack)+1:]+'/'+f)
+    return (dirs, files)
+
+# Returns [fn(item) for item in items], using up to threads threads.
+# Exceptions are re-raised in the caller - the first in item order wins.
+def parallel(fn, items, threads=THREADS):
+    if threads<=1 or len(items)<2:
+        return [fn(item) for item in items]
+    results=[None]*len(items)
+    errors=[None]*len(items)
+    queue=Queue()
+    for i in range(len(items)):
+        queue.put(i)
+    def worker():
+        while True:
+            try:
+                i=queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[i]=fn(items[i])
+            except:
+                errors[i]=sys.exc_info()
+    pool=[Thread(target=worker) for i in range(min(threads, len(items)))]
+    for t in pool: t.start()
+    for t in pool: t.join()
+    for e in errors:
+        if e: raise e[0], e[1], e[2]
+    return results
+
+
+#------------------------------------------------------------------------
+# Parse a library.txt. Returns (valid header?, exports) where exports is a
+# list of (command, virtual path, real path).
+def parselibrary(pack, path):
+    exports=[]
+    h=open(path, 'rU')
+    try:
+        try:
+            valid=(h.readline().strip()[0] in ['I','A'] and
+                   h.readline().split()[0]=='800' and
+                   h.readline().split()[0]=='LIBRARY')
+        except IndexError:
+            valid=False
+        h.seek(0)
+        for line in h:
+            c=line.split()
+            if not c or not c[0].startswith('EXPORT'): continue
+            cmd=c.pop(0)
+            if cmd=='EXPORT_RATIO' and c: c.pop(0)
+            if len(c)<2: continue
+            name=c[0].replace(':','/').replace('\\','/')
+            real=pack+'/'+' '.join(c[1:]).replace(':','/').replace('\\','/')
+            exports.append((cmd, name, real))
+    finally:
+        h.close()
+    return (valid, exports)
+
+
+#------------------------------------------------------------------------
+# Library index for one X-Plane folder
+class LibraryIndex:
+
+    def __init__(self, root):
+        self.root=root
+        self.cachefile=root+'/'+CACHENAME
+        self.packs={}		# packkey of pack path -> dict, see readpack
+        self.dirty=False
+        try:
+            h=open(self.cachefile, 'rb')
+            try:
+                cache=cPickle.load(h)
+            finally:
+                h.close()
+            if cache.get('version')==CACHEVERSION and cache.get('root')==packkey(root):
+                self.packs=cache['packs']
+        except:	# missing, unreadable or from an old version
+            pass
+
+    # Write the cache file, if anything has changed
+    def save(self):
+        if not self.dirty: return
+        tmp=self.cachefile+'.tmp'
+        try:
+            h=open(tmp, 'wb')
+            try:
+                cPickle.dump({'version':CACHEVERSION, 'root':packkey(self.root), 'packs':self.packs}, h, 2)
+            finally:
+                h.close()
+            try:
+                remove(self.cachefile)	# rename won't replace on Windows
+            except OSError:
+                pass
+            rename(tmp, self.cachefile)
+            self.dirty=False
+        except (IOError, OSError):
+            pass	# read-only X-Plane folder - just don't cache
+
+    #------------------------------------------------------------------------
+    # Paths of all scenery packs, in priority order
+    def scenery_packs(self):
+        results=[]
+        for folder in SCENERY:
+            path=self.root+'/'+folder
+            try:
+                packs=listdir(path)
+            except OSError:
+                continue
+            packs.sort()	# X-Plane's order, absent scenery_packs.ini
+            for pack in packs:
+                results.append(path+'/'+pack)
+            # forget packs that have been removed
+            current=dict.fromkeys([packkey(pack) for pack in results])
+            for key in self.packs.keys():
+                if dirname(key)==packkey(path) and not key in current:
+                    del self.packs[key]
+                    self.dirty=True
+        return results
+
+    # Cached details of a pack, re-read if the pack folder or library.txt
+    # has changed since the cache was made.
+    def pack(self, pack):
+        return self.scan([pack])[0]
+
+    # Cached details of each of packs, in the same order. Packs that have
+    # changed are re-read in parallel.
+    def scan(self, packs, threads=THREADS):
+        entries=[]
+        stale=[]	# (index into packs, mtime, old entry)
+        for i in range(len(packs)):
+            entry=self.packs.get(packkey(packs[i]))
+            mtime=getmtime(packs[i])
+            if (entry and entry['mtime']==mtime and
+                (not entry['lib'] or getmtime(entry['lib'])==entry['libmtime'])):
+                entries.append(entry)
+            else:
+                entries.append(None)
+                stale.append((i, mtime, entry))
+        # readpack doesn't modify the index so is safe to call from threads
+        results=parallel(lambda (i, mtime, entry): self.readpack(packs[i], mtime, entry), stale, threads)
+        for j in range(len(stale)):
+            i=stale[j][0]
+            entries[i]=self.packs[packkey(packs[i])]=results[j]
+            self.dirty=True
+        return entries
+
+    def readpack(self, pack, mtime, old=None):
+        entry={'mtime':mtime,	# of the pack folder
+               'lib':None,	# path of library.txt
+               'libmtime':None,
+               'valid':False,	# library.txt has a valid header
+               'exports':[],	# see parselibrary
+               'dirs':None,	# {folder: mtime} of all folders in the pack
+               'files':[]}	# paths of all files in the pack, relative to the pack
+        if old:	# local files are revalidated separately
+            entry['dirs']=old['dirs']
+            entry['files']=old['files']
+        if mtime is None or not isdir(pack):
+            return entry
+        name=findname(pack, 'library.txt')
+        if name:
+            entry['lib']=pack+'/'+name
+            entry['libmtime']=getmtime(entry['lib'])
+            try:
+                (entry['valid'], entry['exports'])=parselibrary(pack, entry['lib'])
+            except IOError:
+                pass
+        return entry
+
+    # Cached list of all files in a pack, re-read if any folder in the pack
+    # has changed.
+    def files(self, pack):
+        return self.scanfiles([pack])[0]
+
+    # Cached lists of all files in each of packs, in the same order. Packs
+    # that have changed are walked in parallel.
+    def scanfiles(self, packs, threads=THREADS):
+        entries=self.scan(packs, threads)
+        stale=[]
+        for i in range(len(packs)):
+            if entries[i]['dirs'] is None:
+                stale.append(i)
+                continue
+            for (folder, mtime) in entries[i]['dirs'].iteritems():
+                if getmtime(folder)!=mtime:
+                    stale.append(i)
+                    break
+        results=parallel(lambda i: walkfiles(packs[i]), stale, threads)
+        for j in range(len(stale)):
+            (entries[stale[j]]['dirs'], entries[stale[j]]['files'])=results[j]
+            self.dirty=True
+        return [entry['files'] for entry in entries]
+
+    #------------------------------------------------------------------------
+    # Library entries of a pack whose real path has the given suffix, as a
+    # list of [virtual path, real path, 'lib']
+    def library_assets(self, pack, suffix, commands=['EXPORT','EXPORT_EXCLUDE','EXPORT_EXTEND']):
+        suffix=suffix.lower()
+        l=len(suffix)
+        return [[name, real, 'lib'] for (cmd, name, real) in self.pack(pack)['exports']
+                if real[-l:].lower()==suffix and cmd in commands]
+
+    # Library entries of all packs whose real path has the given suffix, in
+    # pack order
+    def library(self, suffix, threads=THREADS, commands=['EXPORT','EXPORT_EXCLUDE','EXPORT_EXTEND']):
+        suffix=suffix.lower()
+        l=len(suffix)
+        results=[]
+        for entry in self.scan(self.scenery_packs(), threads):
+            results.extend([[name, real, 'lib'] for (cmd, name, real) in entry['exports']
+                            if real[-l:].lower()==suffix and cmd in commands])
+        return results
+
+    # Dictionary of virtual path -> real path for the given suffix. Where
+    # more than one pack exports a path the first pack wins, as in X-Plane.
+    # EXPORT_BACKUPs are only used if no pack exports the path otherwise.
+    def lookup(self, suffix, threads=THREADS):
+        results={}
+        for commands in [['EXPORT','EXPORT_EXTEND','EXPORT_RATIO','EXPORT_EXCLUDE'], ['EXPORT_BACKUP']]:
+            for (name, real, kind) in self.library(suffix, threads, commands):
+                if not name in results:
+                    results[name]=real
+        return results
+
+    # Files in a pack with the given suffix, as a list of
+    # [path relative to the pack, real path, 'lcl']
+    def local_assets(self, pack, suffix):
+        suffix=suffix.lower()
+        l=len(suffix)
+        return [[f, pack+'/'+f, 'lcl'] for f in self.files(pack) if f[-l:].lower()==suffix]
+
+
+# One index per X-Plane folder for the lifetime of the Blender session
+indices={}
+
+def getindex(root):
+    key=packkey(root)
+    if not key in indices:
+        indices[key]=LibraryIndex(root)
+    return indices[key]
+
+
+#------------------------------------------------------------------------
+# Benchmark: python XPlaneLibIndex.py [number of packs [latency in ms]]
+# Builds a synthetic X-Plane folder in a temporary directory and times cold
+# serial, cold parallel and warm scans of it. A latency can be added to each
+# stat and listdir to mimic a network share.
+if __name__=='__main__':
+    import os
+    from os import makedirs
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    from time import sleep, time
+
+    npacks=len(sys.argv)>1 and int(sys.argv[1]) or 500
+    latency=len(sys.argv)>2 and float(sys.argv[2])/1000 or 0
+    (fast_stat, fast_listdir)=(os.stat, os.listdir)
+    root=mkdtemp()
+    try:
+        for i in range(npacks):
+            pack='%s/%s/pack%03d' % (root, SCENERY[i%len(SCENERY)], i)
+            for sub in ['objects', 'objects/lights', 'terrain']:
+                makedirs(pack+'/'+sub)
+            h=open(pack+'/library.txt', 'w')
+            h.write('A\n800\nLIBRARY\n\n')
+            for j in range(20):
+                open('%s/objects/obj%02d.obj' % (pack,j), 'w').close()
+                open('%s/objects/lights/light%02d.obj' % (pack,j), 'w').close()
+                open('%s/terrain/ter%02d.ter' % (pack,j), 'w').close()
+                # every pack exports the same paths so that precedence matters
+                h.write('EXPORT lib/shared/obj%02d.obj objects/obj%02d.obj\n' % (j,j))
+                h.write('EXPORT lib/pack%03d/ter%02d.ter terrain/ter%02d.ter\n' % (i,j,j))
+            h.close()
+
+        if latency:
+            def slow(fn):
+                def call(*args):
+                    sleep(latency)
+                    return fn(*args)
+                return call
+            os.stat=stat=slow(os.stat)		# os.walk and isdir use os.stat
+            os.listdir=listdir=slow(os.listdir)
+
+        def run(threads, cold):
+            if cold:
+                try:
+                    remove(root+'/'+CACHENAME)
+                except OSError:
+                    pass
+            index=LibraryIndex(root)
+            clock=time()
+            lib=index.library('.obj', threads)
+            lcl=index.scanfiles(index.scenery_packs(), threads)
+            lookup=index.lookup('.obj', threads)
+            clock=time()-clock
+            index.save()
+            return (clock, (lib, lcl, lookup))
+
+        (serial, expected)=run(1, True)
+        print '%d packs in %s, %gms latency' % (npacks, root, latency*1000)
+        print '\t%-24s %8.3fs' % ('cold, serial', serial)
+        for (name, threads, cold) in [('cold, %d threads' % THREADS, THREADS, True),
+                                      ('warm, serial', 1, False),
+                                      ('warm, %d threads' % THREADS, THREADS, False)]:
+            (clock, results)=run(threads, cold)
+            print '\t%-24s %8.3fs  x%.1f  %s' % (name, clock, serial/max(clock,0.001), results==expected and 'identical' or 'DIFFERENT')
+    finally:
+        os.stat=fast_stat
+        os.listdir=fast_listdir
+        rmtree(root)
@@ -27,7 +27,9 @@ from XPlaneUtils import *
 from XPlaneExport import ExportError
 from XPlaneLib import *
 
-def export_hier(parent, all,root,depth):
+# Collects the OBJs to export into batch, writing them out with writeBatch
+# every BATCH_SIZE OBJs. The caller writes out the rest.
+def export_hier(parent, all,root,depth,batch,parallel):
     total = 0
     kids=getChildren(parent, all)
     objs = filter_objects(kids,'Empty','OBJ')
@@ -37,7 +39,7 @@ def export_hier(parent, all,root,depth):
 
     grps = filter_objects(kids,'Empty','GRP')
     for g in grps:
-        total = total + export_hier(g, all,root,depth+1)
+        total = total + export_hier(g, all,root,depth+1,batch,parallel)
 
     # Alex does NOT want the outer-most OBJs to be exported.  His projects
     # apparently contain lots of random objects floating around.
@@ -70,7 +72,7 @@ def export_hier(parent, all,root,depth):
             if partial == '.': parts = 0
             for n in range(parts):
                 prefix += '../'
-            exporter.openFile(my_parts,o,prefix)
+            exporter.openFile(my_parts,o,prefix,True)
             exporter.writeHeader()
             if has_prop(o,'vname'):
                 if pack == None:
@@ -80,7 +82,12 @@ def export_hier(parent, all,root,depth):
                 exporter.file.write("EXPORT %s.obj %s\n" % (strip_suffix(get_prop(o,'vname1',o.name)),os.path.normpath(export_path[len(pack)+1:])))
             if has_prop(o,'vname2'):
                 exporter.file.write("EXPORT %s.obj %s\n" % (strip_suffix(get_prop(o,'vname2',o.name)),os.path.normpath(export_path[len(pack)+1:])))
-            exporter.writeObjects(my_parts)
+            exporter.collectObjects(my_parts)
+            exporter.detach()
+            batch.append(exporter)
+            if len(batch) >= BATCH_SIZE:
+                writeBatch(batch, parallel=parallel)
+                del batch[:]
             total = total + 1
     return total
 #------------------------------------------------------------------------
@@ -96,7 +103,13 @@ try:
     if l==-1: raise ExportError('Save this .blend file first')
     path=os.path.dirname(baseFileName)
 
-    count = export_hier(None, scene.objects,path,0)
+    parallel = PARALLEL_EXPORT
+    a_obj = find_prop_list(scene.objects, 'parallel_export')
+    if a_obj != None:
+        parallel = int(get_prop(a_obj,'parallel_export',parallel))
+    batch = []
+    count = export_hier(None, scene.objects,path,0,batch,parallel)
+    writeBatch(batch, parallel=parallel)
     Draw.PupMenu("Export complete: %d objects." % count)
 
 except ExportError, e:
@@ -29,6 +29,8 @@ from Blender.Mathutils import Matrix, RotationMatrix, TranslationMatrix, MatMult
 from XPlaneUtils import *
 from XPlaneMacros import *
 from XPlaneExport import ExportError
+from XPlaneLib import locate_root
+from XPlaneLibIndex import getindex
 from re import *
 
 def emit_multi_prop(file, obj, prop_name):
@@ -402,9 +404,22 @@ class RoadExport:
         self.log=[]
         self.lib=[]
         self.last_scale=0
-        lib_path=os.path.dirname(filename)+'/library.txt'
-        read_lib(lib_path, self.lib)
-        read_dirs(os.path.dirname(filename),'',self.lib)
+        pack=os.path.dirname(filename)
+        try:
+            (xppath,packpath)=locate_root(pack.replace('\\','/'))
+        except ExportError:
+            packpath=None
+        if packpath==pack.replace('\\','/'):
+            # use the cached library index
+            index=getindex(xppath)
+            self.lib.extend([name for (cmd, name, real) in index.pack(packpath)['exports']
+                             if cmd in ['EXPORT','EXPORT_EXCLUDE','EXPORT_EXTEND']])
+            self.lib.extend([i[0] for i in index.local_assets(packpath, '.obj')])
+            index.save()
+        else:
+            lib_path=pack+'/library.txt'
+            read_lib(lib_path, self.lib)
+            read_dirs(pack,'',self.lib)
 
     #------------------------------------------------------------------------
     def export(self, scene):
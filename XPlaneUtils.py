@@ -9,8 +9,10 @@
 
 import sys
 import os
+import marshal
 from math import sqrt, sin, cos
 from os.path import exists, join
+from tempfile import gettempdir
 import Blender
 from Blender import Registry, Types, Image, Mesh, Object, Scene, Text, Window, Material, Texture
 from Blender.Mathutils import Matrix, Vector, Euler
@@ -457,7 +459,98 @@ def make_short_name(full_path):
     return short
 
 # Read in datarefs
+#--------------------------------------------------------------------------------
+# DataRefs.txt is parsed once per Blender session, and the result is also
+# cached in DATAREFS_CACHE in Blender's temp dir (or the user's Blender data
+# dir, or the system temp dir, if that isn't set or writable) so that scripts
+# don't have to parse it at startup. The cache is keyed on the location, size
+# and modification time of DataRefs.txt.
+
+DATAREFS_CACHE='XPlane2Blender.datarefcache'
+DATAREFS_VERSION=1	# bump if the parsed format changes
+
+_datarefs=None		# (datarefs, hierarchy) once loaded
+
+# Returns (datarefs, hierarchy), where datarefs maps short names to
+# (path, number of values) or None if ambiguous, and hierarchy is a tree of
+# dicts with the number of values at the leaves. Shared - don't modify.
 def getDatarefs():
+    global _datarefs
+    if _datarefs==None:
+        for sdir in ['uscriptsdir', 'scriptsdir']:
+            if (Blender.Get(sdir) and
+                exists(join(Blender.Get(sdir), 'DataRefs.txt'))):
+                _datarefs=loadDatarefs(join(Blender.Get(sdir), 'DataRefs.txt'))
+                break
+        else:
+            raise IOError(0, "Missing DataRefs.txt file. Please re-install.")
+    return _datarefs
+
+# Stands in for the datarefs dict returned by getDatarefs, which is only
+# loaded when first used - so scripts that don't look up datarefs don't
+# pay for loading them.
+class LazyDatarefs:
+    def __contains__(self, name):
+        return name in getDatarefs()[0]
+
+    def __getitem__(self, name):
+        return getDatarefs()[0][name]
+
+    def __iter__(self):
+        return iter(getDatarefs()[0])
+
+    def __len__(self):
+        return len(getDatarefs()[0])
+
+    def get(self, name, default=None):
+        return getDatarefs()[0].get(name, default)
+
+    def keys(self):
+        return getDatarefs()[0].keys()
+
+def datarefCaches():
+    caches=[]
+    for d in [Blender.Get('tempdir'), Blender.Get('udatadir'), gettempdir()]:
+        if d and not join(d, DATAREFS_CACHE) in caches:
+            caches.append(join(d, DATAREFS_CACHE))
+    return caches
+
+def loadDatarefs(path):
+    st=os.stat(path)
+    key=(DATAREFS_VERSION, sys.version, path, st.st_size, st.st_mtime)
+    caches=datarefCaches()
+    for cache in caches:
+        try:
+            h=file(cache, 'rb')
+            try:
+                (k, datarefs, hierarchy)=marshal.load(h)
+            finally:
+                h.close()
+            if k==key:
+                return (datarefs, hierarchy)
+        except:	# missing, unreadable or from another version of Python
+            pass
+
+    (datarefs, hierarchy)=parseDatarefs(path)
+    for cache in caches:
+        tmp=cache+'.tmp'
+        try:
+            h=file(tmp, 'wb')
+            try:
+                marshal.dump((key, datarefs, hierarchy), h)
+            finally:
+                h.close()
+            try:
+                os.remove(cache)	# rename won't replace on Windows
+            except OSError:
+                pass
+            os.rename(tmp, cache)
+            break
+        except (IOError, OSError):
+            pass	# read-only - try the next location
+    return (datarefs, hierarchy)
+
+def parseDatarefs(path):
     counts={'engines':8,
             'wings':56,	# including props and pylons?
             'doors':20,
@@ -465,68 +558,63 @@ def getDatarefs():
     datarefs={}
     hierarchy={}
     err=IOError(0, "Corrupt DataRefs.txt file. Please re-install.")
-    for sdir in ['uscriptsdir', 'scriptsdir']:
-        if (Blender.Get(sdir) and
-            exists(join(Blender.Get(sdir), 'DataRefs.txt'))):
-            f=file(join(Blender.Get(sdir), 'DataRefs.txt'), 'rU')
-            d=f.readline().split()
-            if len(d)!=7 or d[0]!='2': raise err    # wtf?
-            for line in f:
-                d=line.split()
-                if not d: continue
-                if len(d)<3: raise err
-                sname=make_short_name(d[0])
-                ref=d[0].split('/')
-
-                if ref[1] in ['test', 'version']:
-                    continue            # hack: no usable datarefs
-
-                n=1                    # scalar by default
-                for c in ['int', 'float', 'double']:
-                    if d[1].lower().startswith(c):
-                        if len(d[1])>len(c):        # is array
-                            suffix = d[1][len(c)+1:-1]
-                            for dd in suffix.split(']['):
-                                n = n * int(dd)
-                        break
-                else:
-                    n=0                    # not a usable dataref
-
-                if n>99:
-                    if len(sname) > 23:
-                        print 'WARNING - dataref ' + line + ' is too long for key frame table'
-                if n>9:
-                    if len(sname) > 24:
-                        print 'WARNING - dataref ' + line + ' is too long for key frame table'
-                elif n > 1:
-                    if len(sname) > 25:
-                        print 'WARNING - dataref ' + line + ' is too long for key frame table'
-                else:
-                    if len(sname) > 28:
-                        print 'WARNING - dataref ' + line + ' is too long for key frame table'
-#                elif len(sname) > 17:
-#                   print 'WARNING - dataref ' + d[0] + ' is too long for show/hide'
-
-
-                this=hierarchy
-                for i in range(len(ref)-1):
-                    if not ref[i] in this:
-                        this[ref[i]]={}
-                    this=this[ref[i]]
-                this[ref[-1]]=n
-
-                if ref[1]!=('multiplayer'):    # too many ambiguous datarefs
-                    if sname in datarefs:
-                        print 'WARNING - ambiguous short name '+ sname + ' for dataref ' + d[0]
-                    else:
-                        datarefs[sname]=(d[0], n)
-                    if ref[-1] in datarefs:
-                        datarefs[ref[-1]]=None        # ambiguous
-                    else:
-                        datarefs[ref[-1]]=(d[0], n)
-            break
-    else:
-        raise IOError(0, "Missing DataRefs.txt file. Please re-install.")
+    f=file(path, 'rU')
+    d=f.readline().split()
+    if len(d)!=7 or d[0]!='2': raise err    # wtf?
+    for line in f:
+        d=line.split()
+        if not d: continue
+        if len(d)<3: raise err
+        sname=make_short_name(d[0])
+        ref=d[0].split('/')
+
+        if ref[1] in ['test', 'version']:
+            continue            # hack: no usable datarefs
+
+        n=1                    # scalar by default
+        for c in ['int', 'float', 'double']:
+            if d[1].lower().startswith(c):
+                if len(d[1])>len(c):        # is array
+                    suffix = d[1][len(c)+1:-1]
+                    for dd in suffix.split(']['):
+                        n = n * int(dd)
+                break
+        else:
+            n=0                    # not a usable dataref
+
+        if n>99:
+            if len(sname) > 23:
+                print 'WARNING - dataref ' + line + ' is too long for key frame table'
+        if n>9:
+            if len(sname) > 24:
+                print 'WARNING - dataref ' + line + ' is too long for key frame table'
+        elif n > 1:
+            if len(sname) > 25:
+                print 'WARNING - dataref ' + line + ' is too long for key frame table'
+        else:
+            if len(sname) > 28:
+                print 'WARNING - dataref ' + line + ' is too long for key frame table'
+#        elif len(sname) > 17:
+#           print 'WARNING - dataref ' + d[0] + ' is too long for show/hide'
+
+
+        this=hierarchy
+        for i in range(len(ref)-1):
+            if not ref[i] in this:
+                this[ref[i]]={}
+            this=this[ref[i]]
+        this[ref[-1]]=n
+
+        if ref[1]!=('multiplayer'):    # too many ambiguous datarefs
+            if sname in datarefs:
+                print 'WARNING - ambiguous short name '+ sname + ' for dataref ' + d[0]
+            else:
+                datarefs[sname]=(d[0], n)
+            if ref[-1] in datarefs:
+                datarefs[ref[-1]]=None        # ambiguous
+            else:
+                datarefs[ref[-1]]=(d[0], n)
+    f.close()
     return (datarefs, hierarchy)
 
 #--------------------------------------------------------------------------------
@@ -606,7 +694,77 @@ def filter_objects(objs, type, prefix):
 #--------------------------------------------------------------------------------
 
 
+#--------------------------------------------------------------------------------
+# Property lookup. During an export the properties of the objects being
+# exported are snapshotted so that has_prop and friends don't have to call
+# getAllProperties() and scan every property on each lookup.
+
+_props=None		# PropertySnapshot for the current export, if any
+
+class PropertySnapshot:
+    def __init__(self, objects):
+        self.order={}	# object name -> upper-case property names in property order
+        self.props={}	# object name -> {upper-case property name: data as a string}
+        self.index={}	# upper-case property name -> {names of objects that have it}
+        self.found={}	# (object name, upper-case property name) -> result of find
+        for o in objects:
+            while o!=None and not o.name in self.props:
+                self.add(o)
+                o=o.getParent()
+
+    def add(self, o):
+        order=[]
+        props={}
+        for p in o.getAllProperties():
+            u=p.name.upper()
+            order.append(u)
+            if not u in props:	# first one wins
+                props[u]=str(p.data)
+                if u in self.index:
+                    self.index[u][o.name]=True
+                else:
+                    self.index[u]={o.name:True}
+        self.order[o.name]=order
+        self.props[o.name]=props
+
+    # Properties of o, snapshotting it if it wasn't in the export
+    def get(self, o):
+        if not o.name in self.props:
+            self.add(o)
+        return self.props[o.name]
+
+    # Value of property u (upper case) on o or its parents, or None
+    def find(self, o, u):
+        key=(o.name, u)
+        if key in self.found:
+            return self.found[key]
+        v=None
+        p=o
+        while p!=None:
+            props=self.get(p)
+            if u in props:
+                v=props[u]
+                break
+            p=p.getParent()
+        self.found[key]=v
+        return v
+
+# Snapshot the properties of the objects (and their parents) being exported.
+# Returns False if there is already a snapshot.
+def snapshot_props(objects):
+    global _props
+    if _props!=None:
+        return False
+    _props=PropertySnapshot(objects)
+    return True
+
+def release_props():
+    global _props
+    _props=None
+
 def has_prop(o,n):
+    if _props:
+        return _props.find(o, n.upper())!=None
     for p in o.getAllProperties():
         if p.name.upper() == n.upper():
             return True
@@ -616,6 +774,15 @@ def has_prop(o,n):
         return False
 
 def has_close_prop(o,l):
+    if _props:
+        while o!=None:
+            _props.get(o)
+            for u in _props.order[o.name]:
+                for pname in l:
+                    if pname.upper() == u:
+                        return pname
+            o=o.getParent()
+        return None
     for p in o.getAllProperties():
         for pname in l:
             if pname.upper() == p.name.upper():
@@ -626,6 +793,11 @@ def has_close_prop(o,l):
         return None
 
 def get_prop(o,n,d):
+    if _props:
+        v=_props.find(o, n.upper())
+        if v==None:
+            return d
+        return v
     for p in o.getAllProperties():
         if p.name.upper() == n.upper():
             return str(p.data)
@@ -635,10 +807,19 @@ def get_prop(o,n,d):
         return d
 
 def find_prop_list(l,n):
-    for o in l:
-        for p in o.getAllProperties():
-            if p.name.upper() == n.upper():
+    if _props:
+        u=n.upper()
+        for o in l:
+            _props.get(o)
+        have=_props.index.get(u, {})
+        for o in l:
+            if o.name in have:
                 return o
+    else:
+        for o in l:
+            for p in o.getAllProperties():
+                if p.name.upper() == n.upper():
+                    return o
     rents=[]
     for o in l:
         if o.getParent() != None:
@@ -0,0 +1,276 @@
+#
+# Copyright (c) 2013 Jonathan Harris
+#
+# This code is licensed under version 2 of the GNU General Public License.
+# http://www.gnu.org/licenses/gpl-2.0.html
+#
+# Benchmark for the OBJ8 exporter. Run it from the scripts directory against
+# one or more of the .blend files in this folder, eg:
+#
+#   for f in test/*.blend; do blender -b $f -P test/bench_export8.py; done
+#
+# Each file is exported once with the current code and once with the
+# reference implementations below (which are what the exporter used to do),
+# the timings are printed and the two outputs are checked to be identical.
+# The state changes produced by some alternative state weights are then
+# printed. A detached exporter, as used by bulk export, is checked to survive
+# being pickled, and a batch is written one at a time and with a pool of
+# processes, which must give the same output. The reference state sort is
+# checked against Prim.sortkey for each of the state orderings, and the table
+# output is compared on a synthetic object with 1M indices.  The peak resident
+# set size is printed after each stage where the platform can report it.  The
+# exported files go in a temporary folder which is removed afterwards.
+#
+
+import time
+from cPickle import dumps, loads
+from cStringIO import StringIO
+from os.path import basename, join, splitext
+from random import random, randrange, seed
+from shutil import rmtree
+from tempfile import mkdtemp
+try:
+    from resource import getrusage, RUSAGE_SELF
+except ImportError:
+    getrusage=None	# not available on Windows
+import Blender
+import XPlaneExport8_util
+from XPlaneExport8_util import OBJexport8, Prim, DEFMAT, order_tris, tri_planes, VT, VLINE, VLIGHT, write_tables, writeBatch, state_order, STATE_WEIGHTS
+from XPlaneExport import getTexture
+from XPlaneUtils import Vertex, UV
+
+
+# Reference vertex welding: linear scan of the VTs made from each mesh vertex
+class LinearVTIndex:
+    def __init__(self, vt_list):
+        self.vt=vt_list
+        self.vti={}
+
+    def find(self, vi, vt):
+        for j in self.vti.get(vi, []):
+            if vt.equals(self.vt[j]):
+                return j
+        return None
+
+    def add(self, vi, j):
+        self.vti.setdefault(vi, []).append(j)
+
+    def weld(self, vi, j, vt):
+        q=self.vt[j]
+        q.s=(q.s+vt.s)/2
+        q.t=(q.t+vt.t)/2
+
+
+# Reference state sort: Python-level comparison of each pair of prims, with every tri's plane worked out up front.
+# The weighted states are compared in the order given by state_order, as Prim.sortkey does.
+geo={}
+
+def cmp_group(self, other):
+    if self.group == other.group: return 0
+    elif self.group == None: return -1
+    elif other.group == None: return 1
+    else: return cmp(self.group.name, other.group.name)
+
+def cmp_mat(self, other):
+    if self.mat == other.mat: return 0
+    elif self.mat == DEFMAT: return -1
+    elif other.mat == DEFMAT: return 1
+    else: return cmp(self.mat,other.mat)
+
+# In STATE_FIELDS order
+state_cmps=[lambda a,b: cmp(a.layer_now,b.layer_now),
+            cmp_group,
+            lambda a,b: cmp(a.lit_level,b.lit_level),
+            lambda a,b: cmp(a.alpha,b.alpha),
+            lambda a,b: cmp(a.flags&Prim.BUCKET2,b.flags&Prim.BUCKET2),
+            lambda a,b: cmp(a.anim_idx,b.anim_idx),
+            cmp_mat,
+            lambda a,b: cmp(a.flags&Prim.BUCKET1,b.flags&Prim.BUCKET1),
+            lambda a,b: cmp(a.region,b.region)]
+
+def cmp_prims(self, other, order=None):
+    for i in order or range(len(state_cmps)):
+        c=state_cmps[i](self, other)
+        if c: return c
+    if self.style != other.style:
+        return cmp(self.style,other.style)
+    elif self.image != other.image:
+        return cmp(self.image,other.image)
+    elif self.manip != other.manip:
+        return cmp(self.manip,other.manip)
+    elif self.surface != other.surface:
+        return cmp(self.surface,other.surface)
+    elif self.style == 'Tri':
+        if self.alpha[0] > Prim.TEST:
+            return order_tris(geo[self],geo[other])
+        else:
+            return order_tris(geo[other],geo[self])
+    else:
+        return 0
+
+def cmp_sort_prims(prims, vt_list, order=None):
+    geo.clear()
+    geo.update([(p,plane) for (plane,p) in tri_planes([p for p in prims if p.style=='Tri'], vt_list)])
+    prims.sort(lambda a,b: cmp_prims(a,b,order))
+    geo.clear()
+
+
+# Reference table output: one write per row through __str__
+def linewise_write_tables(file, vt, vline, vlight, indices):
+    for q in vt:
+        file.write("VT\t%s\n" % q)
+    if vt:
+        file.write("\n")
+    for q in vline:
+        file.write("VLINE\t%s\n" % q)
+    if vline:
+        file.write("\n")
+    for q in vlight:
+        file.write("VLIGHT\t%s\n" % q)
+    if vlight:
+        file.write("\n")
+    n=len(indices)
+    for i in range(0, n-9, 10):
+        file.write("IDX10\t"+' '.join([str(j) for j in indices[i:i+10]])+"\n")
+    for i in range(n-(n%10), n):
+        file.write("IDX\t%d\n" % indices[i])
+
+
+def export(filename, weights=STATE_WEIGHTS):
+    objects=Blender.Scene.GetCurrent().objects
+    exporter=OBJexport8(filename)
+    exporter.state_weights=weights
+    exporter.texture=getTexture(exporter,objects,False,8)
+    exporter.texture_draped=getTexture(exporter,objects,False,8,True)
+    frame=Blender.Get('curframe')
+    clock=time.time()
+    exporter.file=open(filename, 'w')
+    exporter.writeHeader()
+    exporter.writeObjects(objects)
+    clock=time.time()-clock
+    Blender.Set('curframe', frame)
+    return (clock, exporter)
+
+
+# Collect and detach an exporter, as the bulk exporter does
+def collect(filename):
+    objects=Blender.Scene.GetCurrent().objects
+    exporter=OBJexport8(filename)
+    exporter.texture=getTexture(exporter,objects,False,8)
+    exporter.texture_draped=getTexture(exporter,objects,False,8,True)
+    frame=Blender.Get('curframe')
+    exporter.file=StringIO()
+    exporter.writeHeader()
+    exporter.collectObjects(objects)
+    exporter.detach()
+    Blender.Set('curframe', frame)
+    return exporter
+
+
+def peakrss():
+    if getrusage:
+        return 'peak RSS %dKB' % getrusage(RUSAGE_SELF).ru_maxrss
+    else:
+        return ''
+
+
+# (name, module attribute, reference implementation)
+references=[('vertex welding', 'VTIndex', LinearVTIndex),
+            ('state sort', 'sort_prims', cmp_sort_prims),
+            ('table output', 'write_tables', linewise_write_tables)]
+
+tmpdir=mkdtemp()	# outputs are scratch, so keep them out of the test folder
+base=join(tmpdir, splitext(basename(Blender.Get('filename')))[0])
+try:
+    (new, exporter)=export(base+'_bench_new.obj')
+    print '%s: %d VT, %d primitives' % (basename(Blender.Get('filename')), len(exporter.vt), exporter.nprim)
+    print '\t%-20s %8.3fs  %s  %s' % ('current', new, exporter.stateReport().split('\n')[0], peakrss())
+
+    for (name, attr, ref) in references:
+        saved=getattr(XPlaneExport8_util, attr)
+        setattr(XPlaneExport8_util, attr, ref)
+        try:
+            (old, foo)=export(base+'_bench_ref.obj')
+        finally:
+            setattr(XPlaneExport8_util, attr, saved)
+        same=open(base+'_bench_new.obj').read()==open(base+'_bench_ref.obj').read()
+        print '\t%-20s %8.3fs  x%.1f  %s' % ('reference '+name, old, old/max(new,0.001), same and 'identical' or 'DIFFERENT')
+
+    # Alternative state orderings
+    orderings=[('anim before material', {'anim':25}),
+               ('material first', {'material':85}),
+               ('hard surface first', {'bucket1':85}),
+               ('region first', {'region':85})]
+    for (name, weights) in orderings:
+        (t, foo)=export(base+'_bench_ref.obj', weights)
+        print '\t%-20s %8.3fs  %s' % (name, t, foo.stateReport().split('\n')[0])
+
+    # Detached exporters, as used by bulk export, must survive being pickled to a worker process
+    expected=open(base+'_bench_new.obj').read()
+    exporter=loads(dumps(collect(base+'_bench_detached.obj'), 2))
+    writeBatch([exporter], parallel=False)
+    print '\t%-20s %s' % ('pickled exporter', open(base+'_bench_detached.obj').read()==expected and 'identical' or 'DIFFERENT')
+
+    # Bulk export written one at a time and by a pool of processes
+    timings=[]
+    for parallel in [False, True]:
+        batch=[collect('%s_bench_batch%d_%d.obj' % (base, parallel, i)) for i in range(4)]
+        clock=time.time()
+        writeBatch(batch, parallel=parallel)
+        clock=time.time()-clock
+        same=True
+        for exporter in batch:
+            same=same and open(exporter.filename).read()==expected
+        timings.append((clock, same))
+    print '\t%-20s %8.3fs  %s' % ('serial batch of 4', timings[0][0], timings[0][1] and 'identical' or 'DIFFERENT')
+    print '\t%-20s %8.3fs  x%.1f  %s' % ('pooled batch of 4', timings[1][0], timings[0][0]/max(timings[1][0],0.001), timings[1][1] and 'identical' or 'DIFFERENT')
+finally:
+    rmtree(tmpdir, True)
+
+# Synthetic prims, to check that the reference comparison and Prim.sortkey agree for each state ordering.
+# Lines and lights only, since tris in the same state are then ordered by plane in both.
+class Named:
+    def __init__(self, name):
+        self.name=name
+    def __cmp__(self, other):
+        if other==None: return 1
+        return cmp(self.name, other.name)
+
+seed(0)
+owner=Named('synthetic')
+owner.Layer=1
+groups=[None, Named('a'), Named('b')]
+images=[None, Named('a.png'), Named('b.png')]
+mats=[DEFMAT, ((1,0,0),(0,0,0),0), ((1,1,1),(0,0,0),0.5)]
+prims=[]
+for i in range(10000):
+    p=Prim(owner, groups[randrange(3)], randrange(512), Prim.SURFACES[randrange(3)], mats[randrange(3)],
+           images[randrange(3)], None, randrange(3), Prim.STYLE[randrange(1,4)])
+    p.layer_now=randrange(3)
+    p.lit_level=[None, 'sim/a', 'sim/b'][randrange(3)]
+    p.alpha=[Prim.NOALPHA, [Prim.TEST,0.5], [Prim.BLEND,0.0]][randrange(3)]
+    p.region=randrange(-1,2)
+    p.manip=['', 'ATTR_manip_none'][randrange(2)]
+    prims.append(p)
+print 'synthetic: %d primitives' % len(prims)
+for (name, weights) in [('default', {})]+orderings:
+    order=state_order(weights)
+    prims.sort(lambda a,b: cmp_prims(a,b,order))
+    keys=[p.sortkey(order) for p in prims]
+    print '\t%-20s %s' % ('state sort '+name, keys==sorted(keys) and 'identical' or 'DIFFERENT')
+
+# Synthetic object with 1M indices
+seed(0)
+vt=[VT(Vertex(random()*100,random()*100,random()*100), Vertex(random(),random(),random()), UV(random(),random())) for i in range(333334)]
+vline=[VLINE(Vertex(random(),random(),random()), [random(),random(),random()]) for i in range(1000)]
+vlight=[VLIGHT(Vertex(random(),random(),random()), [random(),random(),random()]) for i in range(1000)]
+indices=[randrange(len(vt)) for i in range(1000003)]
+timings=[]
+for fn in [write_tables, linewise_write_tables]:
+    f=StringIO()
+    clock=time.time()
+    fn(f, vt, vline, vlight, indices)
+    timings.append((time.time()-clock, f.getvalue()))
+print 'synthetic: %d VT, %d indices  %s' % (len(vt), len(indices), peakrss())
+print '\t%-20s %8.3fs' % ('current', timings[0][0])
+print '\t%-20s %8.3fs  x%.1f  %s' % ('reference table output', timings[1][0], timings[1][0]/max(timings[0][0],0.001), timings[0][1]==timings[1][1] and 'identical' or 'DIFFERENT')